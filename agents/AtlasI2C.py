@@ -6,6 +6,21 @@ import fcntl
 import time
 import copy
 import string
+import asyncio
+import ctypes
+from collections import namedtuple
+
+
+class _SmbusIoctlData(ctypes.Structure):
+    # struct i2c_smbus_ioctl_data from linux/i2c-dev.h
+    _fields_ = [("read_write", ctypes.c_uint8),
+                ("command", ctypes.c_uint8),
+                ("size", ctypes.c_uint32),
+                ("data", ctypes.c_void_p)]
+
+
+# a parsed response: status code, first value, all values, device address
+AtlasReading = namedtuple("AtlasReading", ["status", "value", "values", "address"])
 
 
 class AtlasI2C:
@@ -21,6 +36,26 @@ class AtlasI2C:
     DEFAULT_ADDRESS = 98
     LONG_TIMEOUT_COMMANDS = ("R", "CAL")
     SLEEP_COMMANDS = ("SLEEP", )
+    # time a reading takes per circuit type, from the EZO datasheets, keyed
+    # on the type the "I" command reports; the ORP circuit says "OR"
+    READ_TIMES = {"pH": 0.9, "OR": 0.9, "ORP": 0.9, "RTD": 0.6, "EC": 0.6, "DO": 0.6}
+    # response codes
+    STATUS_SUCCESS = 1
+    STATUS_SYNTAX_ERROR = 2
+    STATUS_PENDING = 254
+    STATUS_NO_DATA = 255
+    # how often to poll a circuit that is still processing
+    RETRY_INTERVAL = 0.05
+    # addresses outside this range are reserved by the I2C specification
+    FIRST_ADDRESS = 0x08
+    LAST_ADDRESS = 0x77
+    # ioctls from linux/i2c-dev.h used to probe the bus
+    I2C_SLAVE = 0x703
+    I2C_FUNCS = 0x705
+    I2C_SMBUS = 0x720
+    I2C_FUNC_SMBUS_QUICK = 0x00010000
+    I2C_SMBUS_WRITE = 0
+    I2C_SMBUS_QUICK = 0
 
     def __init__(self, address=None, moduletype = "", name = "", bus=None):
         '''
@@ -42,6 +77,9 @@ class AtlasI2C:
         self.set_i2c_address(self._address)
         self._name = name
         self._module = moduletype
+        # responses are read into this buffer, no new objects per read
+        self._buffer = bytearray(32)
+        self._view = memoryview(self._buffer)
 
 	
     @property
@@ -71,9 +109,8 @@ class AtlasI2C:
         the commands for I2C dev using the ioctl functions are specified in
         the i2c-dev.h file from i2c-tools
         '''
-        I2C_SLAVE = 0x703
-        fcntl.ioctl(self.file_read, I2C_SLAVE, addr)
-        fcntl.ioctl(self.file_write, I2C_SLAVE, addr)
+        fcntl.ioctl(self.file_read, self.I2C_SLAVE, addr)
+        fcntl.ioctl(self.file_write, self.I2C_SLAVE, addr)
         self._address = addr
 
     def write(self, cmd):
@@ -131,25 +168,70 @@ class AtlasI2C:
         '''
         reads a specified number of bytes from I2C, then parses and displays the result
         '''
-        
-        raw_data = self.file_read.read(num_of_bytes)
-        response = self.get_response(raw_data=raw_data)
-        #print(response)
-        is_valid, error_code = self.response_valid(response=response)
-
-        if is_valid:
-            char_list = self.handle_raspi_glitch(response[1:])
-            result = "Success " + self.get_device_info() + ": " +  str(''.join(char_list))
-            #result = "Success: " +  str(''.join(char_list))
-        else:
-            result = "Error " + self.get_device_info() + ": " + error_code
+        status, length = self.read_into(num_of_bytes)
+        return self.format_response(status, length)
+
+    def read_into(self, num_of_bytes=31):
+        '''
+        read a response into the preallocated buffer and clear the MSB
+        glitch in place, returns (status code, payload length), the payload
+        is self._buffer[1:1 + length]
+        '''
+        n = self.file_read.readinto(self._view[:num_of_bytes])
+        if not n:
+            return None, 0
+        buf = self._buffer
+        for i in range(1, n):
+            buf[i] &= 0x7F
+        end = buf.find(0, 1, n)
+        if end < 0:
+            end = n
+        return buf[0], end - 1
+
+    def read_result(self, num_of_bytes=31):
+        '''
+        read a response as an AtlasReading, the values are parsed straight
+        from the buffer, value is None if the response is not numeric
+        '''
+        status, length = self.read_into(num_of_bytes)
+        return self.parse_result(status, length)
+
+    def parse_result(self, status, length):
+        if status != self.STATUS_SUCCESS:
+            return AtlasReading(status, None, (), self._address)
+        view = self._view
+        buf = self._buffer
+        end = length + 1
+        values = []
+        start = 1
+        try:
+            while start < end:
+                comma = buf.find(44, start, end)  # ','
+                if comma < 0:
+                    comma = end
+                values.append(float(view[start:comma]))
+                start = comma + 1
+        except ValueError:
+            return AtlasReading(status, None, (), self._address)
+        if not values:
+            return AtlasReading(status, None, (), self._address)
+        return AtlasReading(status, values[0], tuple(values), self._address)
 
-        return result
+    def format_response(self, status, length):
+        '''
+        the "Success <module> <address> <name>: <response>" form
+        '''
+        if status == self.STATUS_SUCCESS or status is None:
+            payload = self._buffer[1:1 + length].decode('latin-1')
+            return "Success " + self.get_device_info() + ": " + payload
+        return "Error " + self.get_device_info() + ": " + str(status)
 
     def get_command_timeout(self, command):
         timeout = None
         if command.upper().startswith(self.LONG_TIMEOUT_COMMANDS):
             timeout = self._long_timeout
+            if command.upper() == "R":
+                timeout = self.READ_TIMES.get(self._module, timeout)
         elif not command.upper().startswith(self.SLEEP_COMMANDS):
             timeout = self.short_timeout
 
@@ -168,23 +250,65 @@ class AtlasI2C:
             time.sleep(current_timeout)
             return self.read()
 
+    async def async_query_result(self, command, deadline=None):
+        '''
+        asyncio version of query returning an AtlasReading: write the
+        command, await the conversion time of this circuit instead of
+        blocking, then read, polling again every RETRY_INTERVAL while the
+        circuit still reports it is busy, until deadline (seconds after the
+        command) has passed
+        '''
+        self.write(command)
+        current_timeout = self.get_command_timeout(command=command)
+        if not current_timeout:
+            return None
+        if deadline is None:
+            deadline = self._long_timeout
+        end = time.monotonic() + deadline
+        await asyncio.sleep(current_timeout)
+        while True:
+            status, length = self.read_into()
+            if status != self.STATUS_PENDING or time.monotonic() >= end:
+                return self.parse_result(status, length)
+            await asyncio.sleep(self.RETRY_INTERVAL)
+
     def close(self):
         self.file_read.close()
         self.file_write.close()
 
+    def supports_quick_write(self):
+        funcs = ctypes.c_ulong()
+        try:
+            fcntl.ioctl(self.file_read, self.I2C_FUNCS, funcs)
+        except IOError:
+            return False
+        return bool(funcs.value & self.I2C_FUNC_SMBUS_QUICK)
+
+    def probe(self, addr, quick=True):
+        '''
+        check whether a device acknowledges addr. like i2cdetect, use an
+        SMBus quick write, except in the ranges where a quick write can
+        corrupt EEPROMs and latch some chips, which are probed with a read
+        '''
+        self.set_i2c_address(addr)
+        try:
+            if quick and not (0x30 <= addr <= 0x37 or 0x50 <= addr <= 0x5F):
+                data = _SmbusIoctlData(self.I2C_SMBUS_WRITE, 0, self.I2C_SMBUS_QUICK, None)
+                fcntl.ioctl(self.file_write, self.I2C_SMBUS, data)
+            else:
+                self.file_read.read(1)
+        except IOError:
+            return False
+        return True
+
     def list_i2c_devices(self):
         '''
         save the current address so we can restore it after
         '''
         prev_addr = copy.deepcopy(self._address)
-        i2c_devices = []
-        for i in range(0, 128):
-            try:
-                self.set_i2c_address(i)
-                self.read(1)
-                i2c_devices.append(i)
-            except IOError:
-                pass
+        quick = self.supports_quick_write()
+        i2c_devices = [i for i in range(self.FIRST_ADDRESS, self.LAST_ADDRESS + 1)
+                       if self.probe(i, quick)]
         # restore the address we were using
         self.set_i2c_address(prev_addr)
 
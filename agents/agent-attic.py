@@ -1,161 +1,67 @@
 #!/usr/bin/python3
-import logging
-import coloredlogs
-import time
-import board
-import adafruit_dht
-from datetime import datetime
 import os, sys
-import signal
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
-import logging.handlers
 
-influx_token = os.getenv("INFLUX_TOKEN")
-influx_address = os.getenv("INFLUX_ADDRESS")
-org = os.getenv("INFLUX_ORG")
-bucket = os.getenv("INFLUX_BUCKET")
-
-# Initial the dht device, with data pin connected to:
-dhtDevice = adafruit_dht.DHT22(board.D23)
+from agent_host import run
 
 POLLTIME = 5
 
-turn_on_temp = 37
-turn_off_temp = 35
-vue_username = os.getenv("VUE_UN")
-vue_password = os.getenv("VUE_PW")
-vue_tokenfile = os.getenv("VUE_TOKENFILE")
-attic_outlet_on = -1
-# -1 : undefined
-#  0 : off
-#  1 : on
-
 # check if first argument exists, will be the config file
 log_filename = 'mylog.log'
 if len(sys.argv) > 1:
     log_filename = sys.argv[1]
     print('logging output to {}'.format(log_filename))
 
-run_loop = True
-def handle_sigterm(signum, frame):
-    global run_loop
-    run_loop = False
-    logging.info('Received terminal signal {}'.format(signum))
-
-signal.signal(signal.SIGTERM, handle_sigterm)
-
-# Set up logging to a file with size limitation and rotation
-max_bytes = 10000000  # 10 MB
-backup_count = 5  # Keep up to 5 old log files
-file_handler = logging.handlers.RotatingFileHandler(
-    log_filename, maxBytes=max_bytes, backupCount=backup_count)
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-logging.getLogger().addHandler(file_handler)
-
-coloredlogs.install(level='INFO')
-logging.info('--- Starting Attic logger ---')
-logging.info('influx_token: {}'.format(influx_token))
-
-def turn_off_attic_fan():
-    import pyemvue
-    global attic_outlet_on
-    global vue_username, vue_password, vue_tokenfile
-    vue = pyemvue.PyEmVue()
-    vue.login(username=vue_username, password=vue_password, token_storage_file=vue_tokenfile)
-    attic_gid = 41020
-    devices = vue.get_devices()
-    for device in devices:
-        vue.populate_device_properties(device)
-        if (device.device_gid == attic_gid):
-            logging.info('Turning off attic fan')
-            device.outlet.outlet_on = False
-            device.outlet = vue.update_outlet(device.outlet)
-            attic_outlet_on = 0
-
-def turn_on_attic_fan():
-    import pyemvue
-    global attic_outlet_on
-    global vue_username, vue_password, vue_tokenfile
-    vue = pyemvue.PyEmVue()
-    vue.login(username=vue_username, password=vue_password, token_storage_file=vue_tokenfile)
-    attic_gid = 41020
-    devices = vue.get_devices()
-    for device in devices:
-        vue.populate_device_properties(device)
-        if (device.device_gid == attic_gid):
-            logging.info('Turning on attic fan')
-            device.outlet.outlet_on = True
-            device.outlet = vue.update_outlet(device.outlet)
-            attic_outlet_on = 1
-
-
-def get_cpu_temp():
-    tFile = open('/sys/class/thermal/thermal_zone0/temp')
-    temp = float(tFile.read())
-    tempC = temp/1000
-    return tempC
-
-
-# file clean up
-try:
-    logging.info('Removing vue token file')
-    os.remove(vue_tokenfile)
-except:
-    logging.warning('Trouble removing vue token file')
-
-while (run_loop):
-    cpu_temp = get_cpu_temp()
-    try:
-        # Print the values to the serial port
-        temperature_c = dhtDevice.temperature
-        temperature_f = temperature_c * (9 / 5) + 32
-        humidity = dhtDevice.humidity
-        current_time = datetime.utcnow()
-        timenow = current_time
-        point_dht22 = Point("DHT22")
-        point_dht22.time(current_time, WritePrecision.NS)
-        point_dht22.field("temp_c", temperature_c)
-        point_dht22.field("temp_f", temperature_f)
-        point_dht22.field("rh", humidity)
-
-        point_cpu = Point("CPU")
-        point_cpu.time(current_time, WritePrecision.NS)
-        point_cpu.field("temp_c", cpu_temp)
-
-        point_fan = Point("FAN")
-        point_fan.time(current_time, WritePrecision.NS)
-        point_fan.field("state", attic_outlet_on)
-
-        logging.info('push to DB, Temp = ' + str(temperature_c) + ' humidity = ' + str(humidity) + ' cputemp = ' + str(cpu_temp))
-        with InfluxDBClient(url=influx_address, token=influx_token, org=org) as client:
-            write_api = client.write_api(write_options=SYNCHRONOUS)
-            write_api.write(bucket, org, point_dht22)
-            write_api.write(bucket, org, point_cpu)
-            write_api.write(bucket, org, point_fan)
-        client.close()
-        
-        logging.info('attic_outlet_on = ' + str(attic_outlet_on))
-        if (temperature_c > turn_on_temp):
-            if (attic_outlet_on != 1):
-                logging.warning('Attic is heating up')
-                turn_on_attic_fan()
-
-        if (temperature_c <= turn_off_temp):
-            if (attic_outlet_on != 0):
-                logging.info('Attic is now cool')
-                turn_off_attic_fan()
-        
-    except RuntimeError as error:
-        # Errors happen fairly often, DHT's are hard to read, just keep going
-        logging.error(error.args[0])
-        time.sleep(POLLTIME)
-        continue
-    except Exception as error:
-        dhtDevice.exit()
-        raise error
-
-    time.sleep(POLLTIME)
-
-logging.info('Terminating measurement')
+config = {
+    "log": log_filename,
+    "loglevel": "INFO",
+    "influx": {
+        "url": os.getenv("INFLUX_ADDRESS"),
+        "token": os.getenv("INFLUX_TOKEN"),
+        "org": os.getenv("INFLUX_ORG"),
+        "bucket": os.getenv("INFLUX_BUCKET"),
+        # points that cannot reach InfluxDB are kept here until it comes back
+        "spool": os.getenv("INFLUX_SPOOL_DIR"),
+    },
+    # only write slowly changing values when they move, with a heartbeat
+    "deadband": {
+        "DHT22": {"max_silence": 300, "fields": {"temp_c": {"abs": 0.1},
+                                                 "temp_f": {"abs": 0.18},
+                                                 "rh": {"abs": 0.5}}},
+        "CPU": {"max_silence": 300, "fields": {"temp_c": {"abs": 0.5}}},
+        "FAN": {"max_silence": 300, "fields": {"state": {},
+                                               "temp_filtered": {"abs": 0.1}}},
+    },
+    # agent_metrics written every interval seconds, served on METRICS_PORT if set
+    "metrics": {"interval": 60, "port": os.getenv("METRICS_PORT")},
+    # recent samples kept next to the log, queried as JSON on STORE_PORT if set
+    "store": {"port": os.getenv("STORE_PORT")},
+    "drivers": [{
+        "type": "attic",
+        "interval": POLLTIME,
+        # the dht device data pin
+        "pin": "D23",
+        # readings compared against the median of the last dht_window
+        "dht_window": 5,
+        "dht_stats_interval": 60,
+        "turn_on_temp": 37,
+        "turn_off_temp": 35,
+        # smoothing of the temperature, seconds
+        "fan_time_constant": 30,
+        # shortest time the fan stays on / off, and between two switch requests
+        "fan_min_on": 300,
+        "fan_min_off": 300,
+        "fan_min_switch_interval": 120,
+        # how often the real outlet state is read back from the cloud
+        "fan_reconcile_interval": 900,
+        "vue_username": os.getenv("VUE_UN"),
+        "vue_password": os.getenv("VUE_PW"),
+        "vue_tokenfile": os.getenv("VUE_TOKENFILE"),
+    }, {
+        # health of the Pi: temperatures, load, memory, SD card I/O, throttling
+        "type": "host",
+        "interval": 60,
+    }],
+}
+
+if __name__ == '__main__':
+    run(config)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+import sys
+
+from agent_host import run, load_config
+
+# runs every sensor driver listed in one JSON config in a single process,
+# see AgentHost in agent_host.py for the format
+if len(sys.argv) > 1:
+    config_file = sys.argv[1]
+    print('Reading config file {}'.format(config_file))
+else:
+    print('Config file now provided, exiting ...')
+    sys.exit()
+
+if __name__ == '__main__':
+    run(load_config(config_file))
@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+import json
+import logging
+import logging.handlers
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import startup
+from influx_writer import InfluxWriter
+from metrics import REGISTRY
+from scheduler import Schedule
+from spool import Spool
+
+# a driver that fails this many samples in a row stops the host so systemd
+# can restart it with fresh hardware handles
+MAX_CONSECUTIVE_FAILURES = 10
+
+
+class SensorDriver:
+    '''
+    base class of the sensors run by AgentHost
+
+    the host calls setup() once, then sample() on every tick of an
+    interval second Schedule whenever ready() says a sample can be taken,
+    on a worker thread of its own so a slow sensor never holds up the
+    others. sample() returns the Samples to write, stamped with the time
+    the hardware was read, close() releases the hardware
+
+    config keys of every driver: interval, schedule ("coalesce" or "skip",
+    see scheduler.py), align (ticks on wall clock multiples of interval).
+    drivers of hardware take backend: "hardware" (default), "fake" for
+    the simulated devices of fake_devices.py or "replay" to play back the
+    recording named by replay; record names a file to record the raw
+    device traffic to
+    '''
+
+    name = None
+    default_interval = 10
+
+    def __init__(self, config):
+        self.config = config
+        self.interval = config.get('interval', self.default_interval)
+        self.schedule = Schedule(self.interval, config.get('schedule', 'coalesce'),
+                                 config.get('align', True))
+        self.state_dir = config.get('state_dir', '.')
+
+    def setup(self):
+        pass
+
+    def ready(self):
+        return True
+
+    def sample(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class AgentHost:
+    '''
+    runs a set of SensorDrivers in one process and routes every sample
+    through the pipeline stages and one InfluxWriter
+
+    config is the JSON agent config:
+
+        {
+            "log": "/var/log/poolflux/agent.log",
+            "loglevel": "INFO",
+            "influx": {"url": ..., "token": ..., "org": ..., "bucket": ...,
+                       "spool": "<spool dir, next to the log by default>"},
+            "downsample": {"resolutions": [60, 3600], ...},
+            "deadband": {"DHT22": {"max_silence": 300, "fields": {...}}, ...},
+            "metrics": {"interval": 60, "port": 9101},
+            "store": {"ring_bytes": 4194304, "max_bytes": 67108864, "port": 9102},
+            "drivers": [{"type": "pool", "interval": 10, ...}, ...],
+            "startup_budget": 20,
+            "clock_speed": 100
+        }
+
+    a stage has process(samples) and flush(), both returning the samples
+    to pass on; stages only run on the host loop thread
+
+    the metrics registry (metrics.py) is written to the "agent_metrics"
+    measurement every metrics interval seconds, tagged with the host name,
+    and served on http://127.0.0.1:<port>/metrics when a port is set
+
+    with a store the recent samples are also kept on the Pi in a
+    LocalStore (local_store.py), queried over JSON on its port
+
+    the time from the process start to each start up stage (startup.py)
+    is logged once the first write went through, with a warning when that
+    took more than startup_budget seconds. with AGENT_STARTUP_REPORT set
+    in the environment the stages are written to that JSON file and the
+    agent stops right after its first write, for the cold start benchmark
+
+    clock_speed runs the whole process on an accelerated clock, for
+    simulating with fake or replayed devices off the Pi
+    '''
+
+    def __init__(self, config, drivers):
+        self.config = config
+        self.drivers = drivers
+        self._running = True
+        # set whenever a sample finishes, the run loop sleeps on it
+        self._wake = threading.Event()
+        self._failures = {}
+        self.writer = None
+        self.metrics = config.get('metrics', {})
+        self.startup_budget = config.get('startup_budget')
+        self._startup_report = os.getenv('AGENT_STARTUP_REPORT')
+        self._started = False
+        self.stages = []
+        self.store = None
+        if 'store' in config:
+            # first, so it keeps every sample at full rate
+            from local_store import LocalStore
+            self.store = LocalStore.from_config(config['store'], os.path.join(
+                os.path.dirname(os.path.abspath(config['log'])), 'store'))
+            self.stages.append(self.store)
+        if 'downsample' in config:
+            from downsample import Downsampler
+            # quiet series are closed one driver interval late
+            self.stages.append(Downsampler.from_config(
+                config['downsample'], max((d.interval for d in drivers), default=0)))
+        if 'deadband' in config:
+            # after downsampling, so the aggregates still see every sample
+            from deadband import DeadbandFilter
+            self.stages.append(DeadbandFilter(config['deadband']))
+        self._stage_time = [
+            REGISTRY.histogram('stage_seconds', {'stage': type(stage).__name__})
+            for stage in self.stages]
+        self._read_time = {}
+        self._failure_count = {}
+        self._overruns = {}
+        self._tick_lag = {}
+        for driver in drivers:
+            labels = {'driver': driver.name}
+            self._read_time[driver] = REGISTRY.histogram(
+                'sensor_read_seconds', labels, help='one driver sample() call')
+            self._failure_count[driver] = REGISTRY.counter(
+                'sensor_failures_total', labels)
+            self._overruns[driver] = REGISTRY.counter(
+                'loop_overruns_total', labels,
+                help='sample slots skipped because the previous sample was still running')
+            self._tick_lag[driver] = REGISTRY.histogram(
+                'tick_lag_seconds', labels, help='sample start behind its scheduled tick')
+
+    def emit(self, records, first_stage=0):
+        for i in range(first_stage, len(self.stages)):
+            if not records:
+                break
+            ts = time.perf_counter()
+            records = self.stages[i].process(records)
+            self._stage_time[i].observe_since(ts)
+        if records:
+            startup.mark('first_sample')
+            self.writer.write(records)
+
+    def flush_stages(self):
+        for i, stage in enumerate(self.stages):
+            self.emit(stage.flush(), i + 1)
+
+    def stop(self):
+        '''
+        end the run loop, safe to call from a signal handler
+        '''
+        self._running = False
+        if self.writer is not None:
+            self.writer.request_flush()
+
+    def open_writer(self):
+        influx = self.config['influx']
+        spool_dir = influx.get('spool') or os.path.join(
+            os.path.dirname(os.path.abspath(self.config['log'])), 'spool')
+        self.writer = InfluxWriter(url=influx['url'], token=influx['token'],
+                                   org=influx['org'], bucket=influx['bucket'],
+                                   spool=Spool(spool_dir))
+
+    def write_metrics(self):
+        self.writer.write(REGISTRY.samples(tags={'host': socket.gethostname()}))
+
+    def run(self):
+        self.open_writer()
+        if self.metrics.get('port'):
+            from metrics import serve
+            serve(int(self.metrics['port']), self.metrics.get('host', '127.0.0.1'))
+            logging.info('Serving metrics on port {}'.format(self.metrics['port']))
+        if self.store is not None and self.config['store'].get('port'):
+            from local_store import serve
+            store = self.config['store']
+            serve(self.store, int(store['port']), store.get('host', '127.0.0.1'))
+            logging.info('Serving the local store on port {}'.format(store['port']))
+        metrics_interval = self.metrics.get('interval', 60)
+        next_metrics = time.monotonic() + metrics_interval
+        executor = ThreadPoolExecutor(max_workers=len(self.drivers),
+                                      thread_name_prefix='driver')
+        # drivers set up side by side, a slow bus probe or cloud login
+        # does not hold up the other sensors
+        setups = []
+        for driver in self.drivers:
+            logging.info('Setting up {} driver'.format(driver.name))
+            setups.append(executor.submit(driver.setup))
+        try:
+            for future in setups:
+                future.result()
+        except BaseException:
+            executor.shutdown(wait=True)
+            self.writer.close()
+            raise
+        startup.mark('drivers_ready')
+
+        running = {}
+        try:
+            while self._running:
+                self._wake.clear()
+                now = time.monotonic()
+                for driver in self.drivers:
+                    future = running.get(driver)
+                    if future is not None:
+                        if not future.done():
+                            continue
+                        del running[driver]
+                        self._collect(driver, future)
+                    schedule = driver.schedule
+                    if schedule.due(now) and driver.ready():
+                        self._tick_lag[driver].observe(now - schedule.next_time)
+                        overruns = schedule.overruns
+                        fire = schedule.fire(now)
+                        if schedule.overruns != overruns:
+                            self._overruns[driver].inc(schedule.overruns - overruns)
+                        if fire:
+                            future = executor.submit(self._sample, driver)
+                            future.add_done_callback(lambda f: self._wake.set())
+                            running[driver] = future
+                if not self._started and 'first_write' in startup.MARKS:
+                    self._startup_done()
+                if metrics_interval and now >= next_metrics:
+                    # straight to the writer, the stages are for sensor data
+                    self.write_metrics()
+                    next_metrics = max(next_metrics + metrics_interval, now)
+                # sleep until the next idle driver is due or a sample
+                # finishes, waking at least every second to notice stop()
+                wait = 1.0
+                for driver in self.drivers:
+                    if driver not in running:
+                        wait = min(wait, driver.schedule.next_time - time.monotonic())
+                self._wake.wait(max(wait, 0.001))
+        except KeyboardInterrupt:
+            logging.info('Received keyboard interrupt')
+        finally:
+            executor.shutdown(wait=True)
+            for driver, future in running.items():
+                self._collect(driver, future)
+            for driver in self.drivers:
+                try:
+                    driver.close()
+                except Exception as error:
+                    logging.error('Closing {} failed: {}'.format(driver.name, error))
+            self.flush_stages()
+            if metrics_interval:
+                self.write_metrics()
+            self.writer.close()
+        logging.info('Measurement stopped, exiting ...')
+
+    def _startup_done(self):
+        self._started = True
+        first_write = startup.MARKS['first_write']
+        if self.startup_budget and first_write > self.startup_budget:
+            logging.warning('Started in {}, over the {}s budget'.format(
+                startup.summary(), self.startup_budget))
+        else:
+            logging.info('Started in {}'.format(startup.summary()))
+        if self._startup_report:
+            with open(self._startup_report, 'w') as f:
+                json.dump(startup.MARKS, f)
+            self.stop()
+
+    def _sample(self, driver):
+        # runs on the driver's worker thread, one sample at a time
+        ts = time.perf_counter()
+        try:
+            return driver.sample()
+        finally:
+            self._read_time[driver].observe_since(ts)
+
+    def _collect(self, driver, future):
+        try:
+            self.emit(future.result())
+            self._failures[driver] = 0
+        except Exception:
+            logging.exception('{} sample failed'.format(driver.name))
+            self._failure_count[driver].inc()
+            self._failures[driver] = self._failures.get(driver, 0) + 1
+            if self._failures[driver] >= MAX_CONSECUTIVE_FAILURES:
+                logging.error('{} failed {} times in a row, stopping'.format(
+                    driver.name, MAX_CONSECUTIVE_FAILURES))
+                self.stop()
+
+
+def setup_logging(config):
+    # Set up logging to a file with size limitation and rotation
+    max_bytes = 10000000  # 10 MB
+    backup_count = 5  # Keep up to 5 old log files
+    file_handler = logging.handlers.RotatingFileHandler(
+        config['log'], maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s: %(message)s'))
+    logging.getLogger().addHandler(file_handler)
+    import coloredlogs
+    coloredlogs.install(level=config.get('loglevel', 'INFO'))
+
+
+def run(config):
+    '''
+    set up logging and SIGTERM handling, build the configured drivers and
+    run them until terminated
+    '''
+    from sensor_drivers import DRIVERS
+
+    setup_logging(config)
+    startup.mark('imports')
+    if config.get('clock_speed'):
+        from fake_devices import install_clock
+        install_clock(config['clock_speed'])
+        logging.warning('Running on a clock {}x faster than real time'.format(
+            config['clock_speed']))
+    state_dir = os.path.dirname(os.path.abspath(config['log']))
+    drivers = []
+    for driver_config in config['drivers']:
+        driver_config.setdefault('state_dir', state_dir)
+        drivers.append(DRIVERS[driver_config['type']](driver_config))
+    logging.info('--- Starting agent with {} ---'.format(
+        ', '.join(driver.name for driver in drivers)))
+
+    host = AgentHost(config, drivers)
+
+    def handle_sigterm(signum, frame):
+        logging.info('Received termination signal {}'.format(signum))
+        host.stop()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    host.run()
+    return host
+
+
+def load_config(config_file):
+    try:
+        with open(config_file, 'r') as cfile:
+            return json.load(cfile)
+    except FileNotFoundError:
+        print(f"The file '{config_file}' was not found.")
+    except json.JSONDecodeError as e:
+        print(f"An error occurred while decoding the JSON file '{config_file}': {e}")
+    sys.exit(1)
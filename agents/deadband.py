@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+from line_protocol import Sample
+
+
+class DeadbandFilter:
+    '''
+    host pipeline stage that drops field values which have not moved since
+    they were last written
+
+    a numeric field is written when it differs from the last written value
+    by more than abs, or by more than rel times that value; any other value
+    (strings, bools, and numbers with abs 0) is written when it changes at
+    all. max_silence seconds after the last write a value is written anyway
+    as a heartbeat. fields without a rule always pass, and a sample whose
+    fields were all suppressed is dropped
+
+    config (the host's "deadband" key), per measurement:
+
+        {"DHT22": {"max_silence": 300,
+                   "fields": {"temp_c": {"abs": 0.1}, "rh": {"abs": 0.5, "rel": 0.01}}},
+         "FAN": {"max_silence": 600, "fields": {"state": {}}}}
+    '''
+
+    def __init__(self, config):
+        self.rules = {}
+        for measurement, rule in config.items():
+            max_silence = int(rule.get('max_silence', 300) * 10**9)
+            self.rules[measurement] = dict(
+                (field, (limits.get('abs', 0), limits.get('rel', 0), max_silence))
+                for field, limits in rule['fields'].items())
+        # (measurement, tags, field) -> (last written value, time)
+        self._last = {}
+        self.suppressed = 0
+
+    def process(self, samples):
+        out = []
+        for sample in samples:
+            rules = (self.rules.get(sample.measurement)
+                     if isinstance(sample, Sample) else None)
+            if rules is None:
+                out.append(sample)
+                continue
+            tags = tuple(sorted(sample.tags.items())) if sample.tags else ()
+            fields = {}
+            for field, value in sample.fields.items():
+                rule = rules.get(field)
+                if rule is None or self._changed(
+                        (sample.measurement, tags, field), value, sample.time, rule):
+                    fields[field] = value
+                else:
+                    self.suppressed += 1
+            if fields:
+                out.append(sample._replace(fields=fields))
+        return out
+
+    def flush(self):
+        return []
+
+    def _changed(self, key, value, ts, rule):
+        if value is None:
+            return False
+        abs_limit, rel_limit, max_silence = rule
+        last = self._last.get(key)
+        if last is not None and ts - last[1] < max_silence:
+            previous = last[0]
+            if (isinstance(value, (int, float)) and not isinstance(value, bool) and
+                    isinstance(previous, (int, float)) and not isinstance(previous, bool)):
+                if abs(value - previous) <= max(abs_limit, rel_limit * abs(previous)):
+                    return False
+            elif value == previous:
+                return False
+        self._last[key] = (value, ts)
+        return True
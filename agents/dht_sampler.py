@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+import logging
+import time
+from collections import deque
+
+
+def _median(values):
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2
+
+
+class _OutlierFilter:
+    '''
+    ring buffer of the last accepted values of one quantity; a new value
+    further than max(limit, 3 scaled MADs) from their median is rejected,
+    unless the last `window // 2 + 1` values were all rejected, then the
+    quantity really moved and the buffer starts over from the new value
+    '''
+
+    def __init__(self, window, limit):
+        self.values = deque(maxlen=window)
+        self.limit = limit
+        self._rejected_run = 0
+
+    def check(self, value):
+        values = self.values
+        if len(values) < 3:
+            return True
+        median = _median(values)
+        mad = _median([abs(v - median) for v in values])
+        if abs(value - median) <= max(self.limit, 3 * 1.4826 * mad):
+            return True
+        self._rejected_run += 1
+        if self._rejected_run <= values.maxlen // 2:
+            return False
+        values.clear()
+        return True
+
+    def add(self, value):
+        self._rejected_run = 0
+        self.values.append(value)
+
+
+class DhtSampler:
+    '''
+    reads temperature and humidity of an adafruit_dht device in one
+    transaction, with retries and outlier rejection
+
+    the DHT22 needs min_interval seconds between transactions and the
+    library silently returns the previous values when asked sooner, also
+    right after a failed read. read() therefore calls measure() once per
+    attempt, spaced min_interval apart, and keeps retrying until the
+    deadline so a checksum error costs 2 seconds instead of the whole
+    sampling slot
+
+    readings that jump away from the median of the last `window` accepted
+    ones (by more than temp_limit C / rh_limit %RH) are rejected as glitches
+    '''
+
+    def __init__(self, device, window=5, min_interval=2.1, temp_limit=2.0,
+                 rh_limit=10.0):
+        self.device = device
+        self.min_interval = min_interval
+        self.temperature = _OutlierFilter(window, temp_limit)
+        self.humidity = _OutlierFilter(window, rh_limit)
+        self._last_attempt = None
+        # time.time_ns() of the transaction read() last returned
+        self.read_time = None
+        self.attempts = 0
+        self.successes = 0
+        self.rejected = 0
+        self.reads = 0
+        self.failed_reads = 0
+
+    def read(self, deadline):
+        '''
+        (temperature_c, humidity) or None when no plausible reading could
+        be taken before the monotonic deadline
+        '''
+        self.reads += 1
+        retry = False
+        while True:
+            now = time.monotonic()
+            if self._last_attempt is not None:
+                wait = self._last_attempt + self.min_interval - now
+                # the first attempt is always made, retries only in time
+                if retry and now + max(wait, 0) > deadline:
+                    break
+                if wait > 0:
+                    time.sleep(wait)
+            self._last_attempt = time.monotonic()
+            read_time = time.time_ns()
+            self.attempts += 1
+            retry = True
+            try:
+                self.device.measure()
+                temperature = self.device.temperature
+                humidity = self.device.humidity
+            except RuntimeError as error:
+                # Errors happen fairly often, DHT's are hard to read, just keep going
+                logging.debug('DHT read failed: {}'.format(error.args[0]))
+                continue
+            if temperature is None or humidity is None:
+                continue
+            self.successes += 1
+            temperature_ok = self.temperature.check(temperature)
+            humidity_ok = self.humidity.check(humidity)
+            if not (temperature_ok and humidity_ok):
+                self.rejected += 1
+                logging.warning('Rejected DHT reading {} C {} %RH'.format(
+                    temperature, humidity))
+                continue
+            self.temperature.add(temperature)
+            self.humidity.add(humidity)
+            self.read_time = read_time
+            return temperature, humidity
+        self.failed_reads += 1
+        return None
+
+    def stats(self):
+        '''
+        counters since start; success_rate is good transactions per attempt
+        '''
+        return {
+            'reads': self.reads,
+            'failed_reads': self.failed_reads,
+            'attempts': self.attempts,
+            'successes': self.successes,
+            'rejected': self.rejected,
+            'success_rate': self.successes / max(self.attempts, 1),
+        }
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+import logging
+from array import array
+
+from line_protocol import Sample
+from metrics import REGISTRY
+
+# slots per field in a window buffer
+SUM, MIN, MAX, COUNT = range(4)
+
+
+def resolution_label(seconds):
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds % size == 0:
+            return '{}{}'.format(seconds // size, unit)
+    return '{}s'.format(seconds)
+
+
+class _Window:
+    '''
+    running sum/min/max/count of every numeric field of one series over
+    one time window, 4 doubles per field in a single array
+    '''
+
+    __slots__ = ('start', 'index', 'values')
+
+    def __init__(self, start):
+        self.start = start
+        self.index = {}
+        self.values = array('d')
+
+    def add(self, fields):
+        values = self.values
+        for key, value in fields.items():
+            if value is None or isinstance(value, (bool, str)):
+                continue
+            i = self.index.get(key)
+            if i is None:
+                i = self.index[key] = len(values)
+                values.extend((value, value, value, 1.0))
+                continue
+            values[i + SUM] += value
+            if value < values[i + MIN]:
+                values[i + MIN] = value
+            if value > values[i + MAX]:
+                values[i + MAX] = value
+            values[i + COUNT] += 1
+
+    def fields(self):
+        values = self.values
+        fields = {}
+        for key, i in self.index.items():
+            count = values[i + COUNT]
+            fields[key + '_mean'] = values[i + SUM] / count
+            fields[key + '_min'] = values[i + MIN]
+            fields[key + '_max'] = values[i + MAX]
+            fields[key + '_count'] = int(count)
+        return fields
+
+
+class Downsampler:
+    '''
+    host pipeline stage that turns raw Samples into mean/min/max/count
+    points over fixed windows at one or more resolutions
+
+    every (measurement, tags, resolution) series keeps one open window;
+    when a sample lands past its end the window is emitted as a Sample of
+    "<measurement>_<resolution>" (pool_1m, DHT22_1h, ...) stamped with the
+    window start, with <field>_mean, _min, _max and _count fields
+
+    the window of a series that went quiet is emitted once another series
+    is grace seconds past its end. a sample that falls into a window its
+    series already emitted is dropped from the aggregates and counted, it
+    would otherwise write a second point with the same time
+
+    config (the host's "downsample" key):
+
+        {"resolutions": [60, 3600], "raw": true, "measurements": ["pool"],
+         "grace": 10}
+
+    raw false drops the raw samples of the downsampled measurements,
+    measurements limits the stage to those names (all when left out),
+    grace defaults to the longest driver interval
+    '''
+
+    def __init__(self, resolutions, raw=True, measurements=None, grace=0):
+        self.resolutions = [int(r * 10**9) for r in resolutions]
+        self.labels = [resolution_label(int(r)) for r in resolutions]
+        self.raw = raw
+        self.measurements = set(measurements) if measurements else None
+        self.grace = int(grace * 10**9)
+        self._windows = {}
+        # end of the last window emitted for every series
+        self._closed = {}
+        self._newest = 0
+        self._late = REGISTRY.counter(
+            'downsample_late_total', help='samples of windows already emitted')
+
+    @classmethod
+    def from_config(cls, config, grace=0):
+        return cls(config['resolutions'], config.get('raw', True),
+                   config.get('measurements'), config.get('grace', grace))
+
+    def process(self, samples):
+        out = []
+        for sample in samples:
+            if not isinstance(sample, Sample) or (
+                    self.measurements is not None and
+                    sample.measurement not in self.measurements):
+                out.append(sample)
+                continue
+            if self.raw:
+                out.append(sample)
+            self._add(sample, out)
+        # close windows of series that went quiet
+        for key in list(self._windows):
+            window = self._windows[key]
+            if window.start + self.resolutions[key[2]] + self.grace <= self._newest:
+                out.append(self._emit(key, window))
+                del self._windows[key]
+        return out
+
+    def flush(self):
+        '''
+        emit the open windows, for shutdown
+        '''
+        out = [self._emit(key, window) for key, window in self._windows.items()]
+        self._windows = {}
+        return out
+
+    def _add(self, sample, out):
+        ts = sample.time
+        self._newest = max(self._newest, ts)
+        tags = tuple(sorted(sample.tags.items())) if sample.tags else ()
+        late = False
+        for r, resolution in enumerate(self.resolutions):
+            key = (sample.measurement, tags, r)
+            start = ts - ts % resolution
+            window = self._windows.get(key)
+            if start < self._closed.get(key, 0) or (
+                    window is not None and start < window.start):
+                late = True
+                continue
+            if window is not None and window.start != start:
+                out.append(self._emit(key, window))
+                window = None
+            if window is None:
+                window = self._windows[key] = _Window(start)
+            window.add(sample.fields)
+        if late:
+            self._late.inc()
+            logging.warning('Downsampler dropped a late {} sample at {}'.format(
+                sample.measurement, ts))
+
+    def _emit(self, key, window):
+        measurement, tags, r = key
+        self._closed[key] = window.start + self.resolutions[r]
+        return Sample('{}_{}'.format(measurement, self.labels[r]),
+                      window.fields(), window.start, dict(tags) or None)
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+import logging
+import queue
+import threading
+import time
+
+from metrics import REGISTRY
+
+
+class VueOutletClient:
+    '''
+    long lived Emporia Vue session for switching smart plug outlets
+
+    logs in once, keeps the token and a device gid -> outlet cache filled
+    from a single get_outlets() call, and performs the updates on a worker
+    thread so the sampling loop never waits on the cloud. on an error the
+    session and cache are dropped and rebuilt on the next request
+
+    backend is anything with the pyemvue PyEmVue login / get_outlets /
+    update_outlet methods, FakeVueBackend for tests, PyEmVue by default
+    '''
+
+    def __init__(self, username, password, tokenfile, backend=None):
+        self._username = username
+        self._password = password
+        self._tokenfile = tokenfile
+        self._backend = backend
+        self._logged_in = False
+        self._outlets = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        # only updated on the worker thread
+        self._call_time = REGISTRY.histogram(
+            'vue_update_seconds', help='one outlet switch through the cloud')
+        self._call_failures = REGISTRY.counter('vue_failures_total')
+        self._thread = threading.Thread(target=self._run, name='vue-outlets', daemon=True)
+        self._thread.start()
+
+    def set_outlet(self, gid, on, callback=None):
+        '''
+        queue switching the outlet of device gid, callback(on, ok) runs on
+        the worker thread once the cloud answered
+        '''
+        self._queue.put((gid, on, callback))
+
+    def read_outlet(self, gid, callback):
+        '''
+        queue reading the outlet of device gid back from the cloud,
+        callback(on, ok) runs on the worker thread with on None if unknown
+        '''
+        self._queue.put((gid, None, callback))
+
+    def get_outlet_state(self, gid, refresh=True):
+        '''
+        True/False for the outlet of device gid, None if it is unknown
+        '''
+        with self._lock:
+            try:
+                if refresh or gid not in self._outlets:
+                    self._load_outlets()
+                outlet = self._outlets.get(gid)
+                return None if outlet is None else bool(outlet.outlet_on)
+            except Exception as error:
+                logging.error('Reading outlet {} failed: {}'.format(gid, error))
+                self._reset()
+                return None
+
+    def close(self, timeout=10):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _vue(self):
+        if self._backend is None:
+            import pyemvue
+            self._backend = pyemvue.PyEmVue()
+        if not self._logged_in:
+            self._backend.login(username=self._username, password=self._password,
+                                token_storage_file=self._tokenfile)
+            self._logged_in = True
+        return self._backend
+
+    def _load_outlets(self):
+        vue = self._vue()
+        if hasattr(vue, 'get_outlets'):
+            outlets = vue.get_outlets()
+        else:
+            # older pyemvue, outlets only come with the device properties
+            outlets = []
+            for device in vue.get_devices():
+                vue.populate_device_properties(device)
+                if getattr(device, 'outlet', None) is not None:
+                    outlets.append(device.outlet)
+        self._outlets = dict((outlet.device_gid, outlet) for outlet in outlets)
+
+    def _reset(self):
+        self._logged_in = False
+        self._outlets = {}
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            gid, on, callback = item
+            if on is None:
+                state = self.get_outlet_state(gid)
+                self._callback(callback, state, state is not None)
+                continue
+            ok = False
+            ts = time.monotonic()
+            with self._lock:
+                try:
+                    if gid not in self._outlets:
+                        self._load_outlets()
+                    outlet = self._outlets[gid]
+                    outlet.outlet_on = on
+                    self._outlets[gid] = self._vue().update_outlet(outlet)
+                    ok = True
+                except Exception as error:
+                    logging.error('Switching outlet {} failed: {}'.format(gid, error))
+                    self._call_failures.inc()
+                    self._reset()
+            self._call_time.observe(time.monotonic() - ts)
+            logging.info('Outlet {} {} in {:.2f}s'.format(
+                gid, 'on' if on else 'off', time.monotonic() - ts))
+            if callback is not None:
+                self._callback(callback, on, ok)
+
+    def _callback(self, callback, state, ok):
+        try:
+            callback(state, ok)
+        except Exception:
+            # a broken callback must not end the thread, later commands
+            # would queue up forever
+            logging.exception('Outlet callback failed')
+
+
+class FakeOutlet:
+    def __init__(self, device_gid, outlet_on=False):
+        self.device_gid = device_gid
+        self.outlet_on = outlet_on
+
+
+class FakeVueBackend:
+    '''
+    local stand-in for PyEmVue, counts the calls made to it and can add a
+    latency to each one to mimic a slow cloud
+    '''
+
+    def __init__(self, gids=(41020,), latency=0.0):
+        self.outlets = dict((gid, FakeOutlet(gid)) for gid in gids)
+        self.latency = latency
+        self.calls = {'login': 0, 'get_outlets': 0, 'update_outlet': 0}
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def login(self, username=None, password=None, token_storage_file=None):
+        self._call('login')
+        return True
+
+    def get_outlets(self):
+        self._call('get_outlets')
+        return [FakeOutlet(o.device_gid, o.outlet_on) for o in self.outlets.values()]
+
+    def update_outlet(self, outlet, on=None):
+        self._call('update_outlet')
+        if on is not None:
+            outlet.outlet_on = on
+        self.outlets[outlet.device_gid].outlet_on = outlet.outlet_on
+        return FakeOutlet(outlet.device_gid, outlet.outlet_on)
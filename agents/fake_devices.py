@@ -0,0 +1,648 @@
+#!/usr/bin/python3
+import asyncio
+import binascii
+import collections
+import json
+import math
+import random
+import struct
+import threading
+import time
+
+from AtlasI2C import AtlasI2C
+
+
+class VirtualClock:
+    '''
+    runs the process clock speed times faster than real time
+
+    install() replaces time.time, time.time_ns, time.monotonic,
+    time.sleep, asyncio.sleep and threading.Event.wait so every sampling
+    loop, scheduler and device fake sees accelerated time: a 10 s tick
+    takes 10 / speed real seconds. asyncio event loops keep their own
+    clock real, their timers get the already scaled delays. time.perf_counter stays real, so the
+    metrics still report what the code really costs. Queue timeouts,
+    like the InfluxWriter flush interval, keep running in real time
+    '''
+
+    def __init__(self, speed):
+        self.speed = float(speed)
+        self._real_monotonic = time.monotonic
+        self._real_time = time.time
+        self._real_time_ns = time.time_ns
+        self._real_sleep = time.sleep
+        self._real_asyncio_sleep = asyncio.sleep
+        self._real_event_wait = threading.Event.wait
+        self._real_loop_time = asyncio.BaseEventLoop.time
+        self._mono_start = time.monotonic()
+        self._wall_start = time.time()
+
+    def monotonic(self):
+        return self._mono_start + (self._real_monotonic() - self._mono_start) * self.speed
+
+    def time(self):
+        return self._wall_start + (self._real_monotonic() - self._mono_start) * self.speed
+
+    def time_ns(self):
+        return int(self.time() * 1e9)
+
+    def sleep(self, seconds):
+        self._real_sleep(max(seconds, 0) / self.speed)
+
+    def install(self):
+        clock = self
+        real_asyncio_sleep = self._real_asyncio_sleep
+        real_event_wait = self._real_event_wait
+        real_monotonic = self._real_monotonic
+
+        async def asyncio_sleep(delay, result=None):
+            return await real_asyncio_sleep(max(delay, 0) / clock.speed, result)
+
+        def event_wait(event, timeout=None):
+            if timeout is not None:
+                timeout = max(timeout, 0) / clock.speed
+            return real_event_wait(event, timeout)
+
+        time.monotonic = self.monotonic
+        time.time = self.time
+        time.time_ns = self.time_ns
+        time.sleep = self.sleep
+        asyncio.sleep = asyncio_sleep
+        asyncio.BaseEventLoop.time = lambda loop: real_monotonic()
+        threading.Event.wait = event_wait
+        return self
+
+    def uninstall(self):
+        time.monotonic = self._real_monotonic
+        time.time = self._real_time
+        time.time_ns = self._real_time_ns
+        time.sleep = self._real_sleep
+        asyncio.sleep = self._real_asyncio_sleep
+        asyncio.BaseEventLoop.time = self._real_loop_time
+        threading.Event.wait = self._real_event_wait
+
+
+def install_clock(speed):
+    '''
+    accelerate the process clock, see VirtualClock
+    '''
+    return VirtualClock(speed).install()
+
+
+def daily(mean, swing, noise, rnd, phase=0.3):
+    '''
+    value source following a daily sine around mean plus gaussian noise
+    '''
+    def value():
+        day = time.time() / 86400
+        return mean + swing * math.sin(2 * math.pi * (day - phase)) + rnd.gauss(0, noise)
+    return value
+
+
+class Recorder:
+    '''
+    appends raw device traffic as JSON lines, one object per event with
+    the device ("dev"), the monotonic seconds since the recording started
+    ("t") and the event data; safe to share between drivers
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def record(self, dev, **event):
+        event['dev'] = dev
+        event['t'] = round(time.monotonic() - self._start, 6)
+        line = json.dumps(event)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def recorder(path):
+    '''
+    the Recorder writing to path, drivers recording to the same file share it
+    '''
+    with _recorders_lock:
+        if path not in _recorders:
+            _recorders[path] = Recorder(path)
+        return _recorders[path]
+
+
+def load_recording(path, dev):
+    '''
+    the events of one device from a Recorder file, in recorded order
+    '''
+    events = []
+    with open(path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['dev'] == dev:
+                events.append(event)
+    return events
+
+
+# Atlas EZO circuits
+
+class FakeCircuit:
+    '''
+    one EZO circuit on a FakeI2CBus. "R" starts a conversion of READ_TIMES
+    seconds, reads before it is done answer STATUS_PENDING like the real
+    circuit. values come from value(), or from a recording: replies maps
+    a command to the recorded raw responses, replayed in a loop
+    '''
+
+    def __init__(self, moduletype, name, value=None, replies=None):
+        self.moduletype = moduletype
+        self.name = name
+        self.value = value
+        self.replies = replies or {}
+        self._served = collections.Counter()
+        self._command = None
+        self._ready_at = 0
+        self._response = b''
+
+    def write(self, command):
+        command = command.rstrip('\0')
+        self._command = command
+        upper = command.upper()
+        if upper in self.replies:
+            self._response = None
+        elif upper == 'R':
+            self._response = '{:.3f}'.format(self.value()).encode()
+        elif upper == 'I':
+            self._response = '?I,{},2.16'.format(self.moduletype).encode()
+        elif upper == 'NAME,?':
+            self._response = '?NAME,{}'.format(self.name).encode()
+        else:
+            self._response = b''
+        timeout = AtlasI2C.SHORT_TIMEOUT
+        if upper == 'R':
+            timeout = AtlasI2C.READ_TIMES.get(self.moduletype, AtlasI2C.LONG_TIMEOUT)
+        self._ready_at = time.monotonic() + timeout
+
+    def read(self):
+        '''
+        the raw response: status byte, payload, NUL
+        '''
+        upper = (self._command or '').upper()
+        recorded = self.replies.get(upper)
+        if recorded:
+            i = self._served[upper]
+            self._served[upper] += 1
+            return bytes.fromhex(recorded[i % len(recorded)])
+        if time.monotonic() < self._ready_at:
+            return bytes((AtlasI2C.STATUS_PENDING, 0))
+        return bytes((AtlasI2C.STATUS_SUCCESS,)) + self._response + b'\0'
+
+
+class FakeI2CBus:
+    '''
+    the circuits answering on one I2C bus, by address
+    '''
+
+    def __init__(self, number=1, circuits=None):
+        self.number = number
+        self.circuits = circuits or {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def pool(cls, seed=1):
+        '''
+        the ORP, pH and RTD circuits of the pool agent
+        '''
+        rnd = random.Random(seed)
+        return cls(circuits={
+            98: FakeCircuit('OR', 'orp', daily(650, 20, 2, rnd)),
+            99: FakeCircuit('pH', 'ph', daily(7.4, 0.1, 0.01, rnd)),
+            102: FakeCircuit('RTD', 'temp', daily(28, 2, 0.05, rnd, 0.35)),
+        })
+
+    @classmethod
+    def replay(cls, path):
+        '''
+        circuits answering with the responses of a recording
+        '''
+        replies = collections.defaultdict(lambda: collections.defaultdict(list))
+        info = {}
+        for event in load_recording(path, 'atlas'):
+            if 'scan' in event:
+                for address in event['scan']:
+                    replies[address]
+            elif 'r' in event:
+                replies[event['addr']][event['cmd'].upper()].append(event['r'])
+            if 'module' in event:
+                info[event['addr']] = (event['module'], event['name'])
+        circuits = {}
+        for address, by_command in replies.items():
+            moduletype, name = info.get(address, ('', ''))
+            circuits[address] = FakeCircuit(moduletype, name, lambda: 0.0,
+                                            dict(by_command))
+        return cls(circuits=circuits)
+
+
+class FakeAtlasI2C(AtlasI2C):
+    '''
+    AtlasI2C talking to a FakeI2CBus instead of /dev/i2c-N, everything
+    above write() and read_into() is the real code. use atlas_class() to
+    get a subclass bound to a bus
+    '''
+
+    fake_bus = None
+
+    def __init__(self, address=None, moduletype="", name="", bus=None):
+        self._address = address or self.DEFAULT_ADDRESS
+        self.bus = bus or self.fake_bus.number
+        self._long_timeout = self.LONG_TIMEOUT
+        self._short_timeout = self.SHORT_TIMEOUT
+        self._name = name
+        self._module = moduletype
+        self._buffer = bytearray(32)
+        self._view = memoryview(self._buffer)
+
+    def set_i2c_address(self, addr):
+        self._address = addr
+
+    def write(self, cmd):
+        circuit = self.fake_bus.circuits.get(self._address)
+        if circuit is None:
+            raise IOError(121, 'Remote I/O error')
+        with self.fake_bus.lock:
+            circuit.write(cmd)
+
+    def read_into(self, num_of_bytes=31):
+        circuit = self.fake_bus.circuits.get(self._address)
+        if circuit is None:
+            raise IOError(121, 'Remote I/O error')
+        with self.fake_bus.lock:
+            raw = circuit.read()[:num_of_bytes]
+        self._buffer[:len(raw)] = raw
+        return self._parse_buffer(len(raw))
+
+    def _parse_buffer(self, n):
+        if not n:
+            return None, 0
+        buf = self._buffer
+        end = buf.find(0, 1, n)
+        if end < 0:
+            end = n
+        return buf[0], end - 1
+
+    def close(self):
+        pass
+
+    def supports_quick_write(self):
+        return True
+
+    def probe(self, addr, quick=True):
+        return addr in self.fake_bus.circuits
+
+
+def atlas_class(bus):
+    return type('FakeAtlasI2C', (FakeAtlasI2C,), {'fake_bus': bus})
+
+
+def recording_atlas_class(cls, rec):
+    '''
+    subclass of an AtlasI2C class that records every command and raw
+    response, and the result of bus scans
+    '''
+
+    class RecordingAtlasI2C(cls):
+        def write(self, cmd):
+            self._last_command = cmd
+            super().write(cmd)
+
+        def read_into(self, num_of_bytes=31):
+            status, length = super().read_into(num_of_bytes)
+            if status is not None:
+                raw = bytes(self._buffer[:length + 1]) + b'\0'
+                rec.record('atlas', addr=self._address, module=self._module,
+                           name=self._name, cmd=getattr(self, '_last_command', ''),
+                           r=raw.hex())
+            return status, length
+
+        def list_i2c_devices(self):
+            addresses = super().list_i2c_devices()
+            rec.record('atlas', scan=addresses)
+            return addresses
+
+    return RecordingAtlasI2C
+
+
+# DHT22
+
+class FakeDHT22:
+    '''
+    stands in for adafruit_dht.DHT22, including its habit of returning the
+    previous values without a new transaction when asked again within 2 s.
+    fail_rate of the transactions raise RuntimeError like checksum errors,
+    glitch_rate return a value off by 10 C. with events (a recording)
+    the recorded readings and errors are replayed in a loop instead
+    '''
+
+    def __init__(self, pin=None, fail_rate=0.1, glitch_rate=0.002, events=None,
+                 seed=1):
+        rnd = random.Random(seed)
+        self._rnd = rnd
+        self._temperature_source = daily(36, 8, 0.1, rnd)
+        self._humidity_source = daily(40, -10, 0.3, rnd)
+        self.fail_rate = fail_rate
+        self.glitch_rate = glitch_rate
+        self._events = events
+        self._served = 0
+        self._last_called = 0
+        self._temperature = None
+        self._humidity = None
+
+    def measure(self):
+        if self._last_called and time.monotonic() - self._last_called <= 2:
+            return
+        self._last_called = time.monotonic()
+        if self._events:
+            event = self._events[self._served % len(self._events)]
+            self._served += 1
+            if 'error' in event:
+                raise RuntimeError(event['error'])
+            self._temperature, self._humidity = event['temp'], event['rh']
+            return
+        if self._rnd.random() < self.fail_rate:
+            raise RuntimeError('Checksum did not validate. Try again.')
+        temperature = round(self._temperature_source(), 1)
+        if self._rnd.random() < self.glitch_rate:
+            temperature += 10
+        self._temperature = temperature
+        self._humidity = round(min(max(self._humidity_source(), 0), 100), 1)
+
+    @property
+    def temperature(self):
+        self.measure()
+        return self._temperature
+
+    @property
+    def humidity(self):
+        self.measure()
+        return self._humidity
+
+    def exit(self):
+        pass
+
+
+class RecordingDHT22:
+    '''
+    wraps a DHT22 device and records every transaction and error
+    '''
+
+    def __init__(self, device, rec):
+        self._device = device
+        self._rec = rec
+
+    def measure(self):
+        try:
+            self._device.measure()
+        except RuntimeError as error:
+            self._rec.record('dht', error=str(error.args[0]))
+            raise
+        self._rec.record('dht', temp=self._device.temperature, rh=self._device.humidity)
+
+    @property
+    def temperature(self):
+        return self._device.temperature
+
+    @property
+    def humidity(self):
+        return self._device.humidity
+
+    def exit(self):
+        self._device.exit()
+
+
+# SEN5x
+
+class _Signal:
+    def __init__(self, value):
+        self.available = value is not None
+        value = value or 0.0
+        self.physical = value
+        self.percent_rh = value
+        self.degrees_celsius = value
+        self.degrees_fahrenheit = value * 9 / 5 + 32
+        self.scaled = value
+
+
+class _Sen5xValues:
+    FIELDS = ('mass_concentration_1p0', 'mass_concentration_2p5',
+              'mass_concentration_4p0', 'mass_concentration_10p0',
+              'ambient_humidity', 'ambient_temperature', 'voc_index', 'nox_index')
+
+    def __init__(self, values):
+        self.values = values
+        for field in self.FIELDS:
+            setattr(self, field, _Signal(values.get(field)))
+
+    def __str__(self):
+        return json.dumps(self.values)
+
+
+class FakeSen5x:
+    '''
+    stands in for Sen5xI2cDevice: a result every period seconds after
+    start_measurement(), random walk particulate values, or the values of
+    a recording replayed in a loop
+    '''
+
+    def __init__(self, period=1.0, events=None, seed=1):
+        self.period = period
+        self._rnd = random.Random(seed)
+        self._events = events
+        self._served = 0
+        self._started = None
+        self._taken = 0
+        self._pm = 5.0
+
+    def get_version(self):
+        return 'fake'
+
+    def get_product_name(self):
+        return 'SEN55'
+
+    def get_serial_number(self):
+        return 'FAKE0000'
+
+    def get_fan_auto_cleaning_interval(self):
+        return 604800
+
+    def device_reset(self):
+        self._started = None
+
+    def start_measurement(self):
+        self._started = time.monotonic()
+        self._taken = 0
+
+    def stop_measurement(self):
+        self._started = None
+
+    def read_device_status(self):
+        return 0
+
+    def read_data_ready(self):
+        if self._started is None:
+            return False
+        return int((time.monotonic() - self._started) / self.period) > self._taken
+
+    def read_measured_values(self):
+        self._taken = int((time.monotonic() - self._started) / self.period)
+        if self._events:
+            event = self._events[self._served % len(self._events)]
+            self._served += 1
+            return _Sen5xValues(event['values'])
+        self._pm = max(self._pm + self._rnd.gauss(0, 0.3), 0.5)
+        return _Sen5xValues({
+            'mass_concentration_1p0': round(self._pm * 0.7, 1),
+            'mass_concentration_2p5': round(self._pm, 1),
+            'mass_concentration_4p0': round(self._pm * 1.1, 1),
+            'mass_concentration_10p0': round(self._pm * 1.2, 1),
+            'ambient_humidity': round(45 + self._rnd.gauss(0, 0.5), 2),
+            'ambient_temperature': round(22 + self._rnd.gauss(0, 0.1), 2),
+            'voc_index': 100 + self._rnd.randint(-5, 5),
+            'nox_index': 1,
+        })
+
+
+class RecordingSen5x:
+    '''
+    wraps a Sen5xI2cDevice and records the values of every result
+    '''
+
+    def __init__(self, device, rec):
+        self._device = device
+        self._rec = rec
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def read_measured_values(self):
+        values = self._device.read_measured_values()
+        recorded = {}
+        for field, unit in (('mass_concentration_1p0', 'physical'),
+                            ('mass_concentration_2p5', 'physical'),
+                            ('mass_concentration_4p0', 'physical'),
+                            ('mass_concentration_10p0', 'physical'),
+                            ('ambient_humidity', 'percent_rh'),
+                            ('ambient_temperature', 'degrees_celsius'),
+                            ('voc_index', 'scaled'),
+                            ('nox_index', 'scaled')):
+            signal = getattr(values, field)
+            if signal.available:
+                recorded[field] = getattr(signal, unit)
+        self._rec.record('sen5x', values=recorded)
+        return values
+
+
+# Teensy serial stream
+
+def encode_frame(seq, samples):
+    '''
+    a read_analog.ino binary frame, see teensy_serial.FrameDecoder
+    '''
+    body = struct.pack('<HB{}H'.format(len(samples)), seq & 0xFFFF, len(samples), *samples)
+    return b'\xa5\x5a' + body + struct.pack('<H', binascii.crc_hqx(body, 0xFFFF))
+
+
+class FakeSerial:
+    '''
+    stands in for serial.Serial on the Teensy port. generates the water
+    level stream in real time of the (virtual) clock: ASCII lines every
+    interval seconds, or with binary one frame of frame_samples samples
+    every frame_samples * interval seconds. with events (a recording) the
+    recorded chunks are replayed at their recorded times, in a loop; the
+    binary frame numbers restart with every loop, which the decoder counts
+    as one gap
+    '''
+
+    def __init__(self, binary=False, interval=0.01, frame_samples=50,
+                 timeout=1, events=None, seed=1):
+        self.binary = binary
+        self.interval = interval
+        self.frame_samples = frame_samples
+        self.timeout = timeout
+        self._events = events
+        self._source = daily(600, 3, 1.5, random.Random(seed))
+        self._start = time.monotonic()
+        self._emitted = 0
+        self._seq = 0
+        self._buffer = bytearray()
+        self._open = True
+
+    def _generate(self):
+        elapsed = time.monotonic() - self._start
+        if self._events:
+            span = self._events[-1]['t'] + self.interval
+            while True:
+                loop, i = divmod(self._emitted, len(self._events))
+                event = self._events[i]
+                if loop * span + event['t'] > elapsed:
+                    break
+                self._buffer += bytes.fromhex(event['data'])
+                self._emitted += 1
+            return
+        step = self.interval * (self.frame_samples if self.binary else 1)
+        due = int(elapsed / step)
+        while self._emitted < due:
+            self._emitted += 1
+            if self.binary:
+                samples = [int(self._source()) for i in range(self.frame_samples)]
+                self._buffer += encode_frame(self._seq, samples)
+                self._seq += 1
+            else:
+                self._buffer += '{}\n'.format(int(self._source())).encode()
+
+    @property
+    def in_waiting(self):
+        self._generate()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+        while self._open:
+            self._generate()
+            if self._buffer or time.monotonic() >= deadline:
+                break
+            time.sleep(min(self.interval, 0.05))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+
+class RecordingSerial:
+    '''
+    wraps a serial port and records every chunk read from it
+    '''
+
+    def __init__(self, ser, rec):
+        self._ser = ser
+        self._rec = rec
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+    def read(self, size=1):
+        data = self._ser.read(size)
+        if data:
+            self._rec.record('serial', data=data.hex())
+        return data
@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+import math
+
+
+class FanController:
+    '''
+    hysteresis control of a fan outlet from a noisy temperature
+
+    the input is smoothed with an exponential moving average of
+    time_constant seconds (sample intervals may vary). the fan is asked on
+    when the filtered temperature is above turn_on_temp and off when it is
+    at or below turn_off_temp, but only after it stayed in its current
+    state for min_on / min_off seconds, never sooner than
+    min_switch_interval seconds after the previous request, and never while
+    a request is still in flight
+
+    the outlet state is only what the backend reported: switched() records
+    the answer to a request, observed() a state read back from the backend
+    at startup and every reconcile_interval seconds (reconcile_due()), so a
+    restart or a manual switch does not lead to redundant cloud calls
+
+    update() returns True/False when the outlet should be switched, None
+    otherwise. the caller owns the clock and the threading, times are
+    monotonic seconds
+    '''
+
+    def __init__(self, turn_on_temp, turn_off_temp, time_constant=30,
+                 min_on=300, min_off=300, min_switch_interval=120,
+                 reconcile_interval=900):
+        self.turn_on_temp = turn_on_temp
+        self.turn_off_temp = turn_off_temp
+        self.time_constant = time_constant
+        self.min_on = min_on
+        self.min_off = min_off
+        self.min_switch_interval = min_switch_interval
+        self.reconcile_interval = reconcile_interval
+        # True/False as last reported by the backend, None when unknown
+        self.state = None
+        # requested state still in flight, None when idle
+        self.pending = None
+        self.filtered = None
+        self._last_input = None
+        self._state_since = None
+        self._last_request = None
+        self._last_reconcile = None
+        self.requests = 0
+        self.failures = 0
+        self.held = 0
+        self.corrections = 0
+
+    def update(self, temp, now):
+        if temp is None or math.isnan(temp):
+            return None
+        if self.filtered is None or self.time_constant <= 0:
+            self.filtered = temp
+        else:
+            alpha = 1 - math.exp(-max(now - self._last_input, 0) / self.time_constant)
+            self.filtered += alpha * (temp - self.filtered)
+        self._last_input = now
+
+        if self.filtered > self.turn_on_temp:
+            want = True
+        elif self.filtered <= self.turn_off_temp:
+            want = False
+        else:
+            return None
+        if want == self.state or want == self.pending:
+            return None
+        if self.pending is not None or not self._may_switch(now):
+            self.held += 1
+            return None
+        self.pending = want
+        self._last_request = now
+        self.requests += 1
+        return want
+
+    def switched(self, on, ok, now):
+        '''
+        answer of the backend to the request for state on
+        '''
+        self.pending = None
+        if ok:
+            self._set_state(on, now)
+        else:
+            self.failures += 1
+
+    def observed(self, on, now):
+        '''
+        outlet state read back from the backend, None if it could not be read
+        '''
+        self._last_reconcile = now
+        if on is None:
+            return
+        if self.state is not None and on != self.state:
+            self.corrections += 1
+        self._set_state(on, now)
+
+    def reconcile_due(self, now):
+        return (self.pending is None and (
+            self._last_reconcile is None or
+            now - self._last_reconcile >= self.reconcile_interval))
+
+    def reconcile_started(self, now):
+        '''
+        a read back was queued, reconcile_due() stays False until the next
+        interval even before observed() got the answer
+        '''
+        self._last_reconcile = now
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'held': self.held,
+            'corrections': self.corrections,
+        }
+
+    def _may_switch(self, now):
+        if (self._last_request is not None and
+                now - self._last_request < self.min_switch_interval):
+            return False
+        if self.state is None or self._state_since is None:
+            return True
+        dwell = self.min_on if self.state else self.min_off
+        return now - self._state_since >= dwell
+
+    def _set_state(self, on, now):
+        if on != self.state:
+            self.state = on
+            self._state_since = now
+
+
+def read_trace(filename):
+    '''
+    (seconds, temp_c) rows from a csv with a time column (epoch seconds,
+    epoch nanoseconds or ISO 8601 like an influx export) and a temp_c column
+    '''
+    import csv
+    from datetime import datetime
+
+    rows = []
+    with open(filename, newline='') as trace:
+        for row in csv.DictReader(trace):
+            ts = row.get('time') or row.get('_time')
+            try:
+                ts = float(ts)
+                if ts > 1e12:
+                    ts /= 1e9
+            except ValueError:
+                ts = datetime.fromisoformat(ts.replace('Z', '+00:00')).timestamp()
+            temp = row.get('temp_c') or row.get('_value')
+            rows.append((ts, float(temp)))
+    rows.sort()
+    return rows
+
+
+def synthetic_trace(days=2, interval=5, seed=1):
+    '''
+    a sunny attic: daily swing between 28 and 44 C plus DHT22 sized noise
+    and the odd bad read
+    '''
+    import random
+
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(int(days * 86400 / interval)):
+        ts = i * interval
+        temp = 36 + 8 * math.sin(2 * math.pi * (ts / 86400 - 0.3))
+        temp += rnd.gauss(0, 0.4)
+        if rnd.random() < 0.002:
+            temp += rnd.choice((-8, 8))
+        rows.append((ts, temp))
+    return rows
+
+
+def simulate(rows, make_controller, backend, gid, reconcile=True,
+             restart_every=None):
+    '''
+    replay a temperature trace through a controller against a fake vue
+    backend, synchronously. make_controller() builds the controller, again
+    every restart_every seconds like an agent restart would; reconcile
+    False never reads the outlet back
+    '''
+    from emporia_fan import FakeOutlet
+
+    start = rows[0][0]
+    controller = make_controller()
+    totals = dict.fromkeys(controller.stats(), 0)
+    last_restart = 0
+    on_seconds = 0.0
+    toggles = 0
+    previous = None
+    for ts, temp in rows:
+        now = ts - start
+        if restart_every and now - last_restart >= restart_every:
+            last_restart = now
+            for key, value in controller.stats().items():
+                totals[key] += value
+            controller = make_controller()
+        if reconcile and controller.reconcile_due(now):
+            backend.get_outlets()
+            controller.observed(backend.outlets[gid].outlet_on, now)
+        want = controller.update(temp, now)
+        if want is not None:
+            toggles += backend.outlets[gid].outlet_on != want
+            backend.update_outlet(FakeOutlet(gid, want))
+            controller.switched(want, True, now)
+        if previous is not None and backend.outlets[gid].outlet_on:
+            on_seconds += now - previous
+        previous = now
+    for key, value in controller.stats().items():
+        totals[key] += value
+    totals['toggles'] = toggles
+    totals['updates'] = backend.calls['update_outlet']
+    totals['reads'] = backend.calls['get_outlets']
+    totals['fan_on_hours'] = on_seconds / 3600
+    return totals
+
+
+def main():
+    import argparse
+    from emporia_fan import FakeVueBackend
+
+    parser = argparse.ArgumentParser(
+        description='replay a temperature trace through the attic fan controller')
+    parser.add_argument('trace', nargs='?',
+                        help='csv with time and temp_c columns, synthetic when left out')
+    parser.add_argument('--on', type=float, default=37)
+    parser.add_argument('--off', type=float, default=35)
+    parser.add_argument('--time-constant', type=float, default=30)
+    parser.add_argument('--min-on', type=float, default=300)
+    parser.add_argument('--min-off', type=float, default=300)
+    parser.add_argument('--min-switch-interval', type=float, default=120)
+    parser.add_argument('--reconcile-interval', type=float, default=900)
+    parser.add_argument('--restart-every', type=float, default=None,
+                        help='simulate an agent restart every so many seconds')
+    args = parser.parse_args()
+
+    rows = read_trace(args.trace) if args.trace else synthetic_trace()
+    gid = 41020
+    runs = [
+        # the old loop: raw readings against the thresholds, no dwell, no
+        # rate limit, outlet state only kept in memory
+        ('raw thresholds', False,
+         lambda: FanController(args.on, args.off, 0, 0, 0, 0)),
+        ('controller', True,
+         lambda: FanController(args.on, args.off, args.time_constant,
+                               args.min_on, args.min_off,
+                               args.min_switch_interval, args.reconcile_interval)),
+    ]
+    print('{} samples over {:.1f} h'.format(
+        len(rows), (rows[-1][0] - rows[0][0]) / 3600))
+    for label, reconcile, make_controller in runs:
+        result = simulate(rows, make_controller, FakeVueBackend(gids=(gid,)),
+                          gid, reconcile, args.restart_every)
+        print('{:15} {}'.format(label, ' '.join(
+            '{}={}'.format(k, round(v, 2) if isinstance(v, float) else v)
+            for k, v in result.items())))
+
+
+if __name__ == '__main__':
+    main()
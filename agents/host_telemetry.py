@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+import glob
+import os
+import threading
+import time
+
+# firmware throttling flags, see vcgencmd get_throttled
+UNDER_VOLTAGE = 0x1
+FREQ_CAPPED = 0x2
+THROTTLED = 0x4
+SOFT_TEMP_LIMIT = 0x8
+THROTTLED_SINCE_BOOT = 0xF0000
+
+THROTTLED_PATHS = ('/sys/devices/platform/soc/soc:firmware/get_throttled',
+                   '/sys/devices/platform/soc/soc:firmware/raspberrypi-hwmon/get_throttled')
+CPU_FREQ_PATH = '/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'
+
+
+class _KernelFile:
+    '''
+    a sysfs or procfs file kept open and re-read from offset 0 into the
+    same buffer, the kernel regenerates the content on every read
+    '''
+
+    def __init__(self, path, size=4096):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def read(self):
+        n = os.preadv(self._fd, [self._buffer], 0)
+        return self._view[:n]
+
+    def read_int(self, base=10):
+        return int(self.read().tobytes(), base)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _open(path, size=4096):
+    try:
+        return _KernelFile(path, size)
+    except OSError:
+        return None
+
+
+class HostTelemetry:
+    '''
+    health of the Pi from sysfs and procfs without reopening any file
+
+    every file is opened once and re-read with preadv into its own buffer.
+    read() returns one dict of fields: temperature of every thermal zone,
+    cpu frequency, load averages and cpu busy share, memory, swap, I/O
+    rates of the SD card (disk) and the firmware throttling flags. rates
+    and the busy share cover the time since the previous read(); sources
+    the machine does not have are left out
+    '''
+
+    def __init__(self, disk='mmcblk0'):
+        self._lock = threading.Lock()
+        self.zones = []
+        for zone in sorted(glob.glob('/sys/class/thermal/thermal_zone*')):
+            temp = _open(os.path.join(zone, 'temp'), 32)
+            if temp is None:
+                continue
+            try:
+                with open(os.path.join(zone, 'type')) as f:
+                    name = f.read().strip()
+            except OSError:
+                name = os.path.basename(zone)
+            name = name.replace('-', '_').replace(' ', '_').lower()
+            if name.endswith('_thermal'):
+                name = name[:-len('_thermal')]
+            self.zones.append(('temp_{}_c'.format(name), temp))
+        self.disk = disk.encode()
+        self._loadavg = _open('/proc/loadavg', 128)
+        self._stat = _open('/proc/stat', 256)
+        self._meminfo = _open('/proc/meminfo', 2048)
+        self._diskstats = _open('/proc/diskstats', 16384)
+        self._cpufreq = _open(CPU_FREQ_PATH, 32)
+        self._throttled = None
+        for path in THROTTLED_PATHS:
+            self._throttled = _open(path, 32)
+            if self._throttled is not None:
+                break
+        self._last_cpu = None
+        self._last_disk = None
+
+    def cpu_temp(self):
+        '''
+        temperature of the first thermal zone in C, None without one
+        '''
+        if not self.zones:
+            return None
+        with self._lock:
+            return self.zones[0][1].read_int() / 1000
+
+    def read(self):
+        fields = {}
+        now = time.monotonic()
+        with self._lock:
+            for name, zone in self.zones:
+                try:
+                    fields[name] = zone.read_int() / 1000
+                except (OSError, ValueError):
+                    # some zones refuse reads while their sensor sleeps
+                    pass
+            if self._cpufreq is not None:
+                fields['cpu_mhz'] = self._cpufreq.read_int() / 1000
+            if self._loadavg is not None:
+                load = self._loadavg.read().tobytes().split()
+                fields['load1'] = float(load[0])
+                fields['load5'] = float(load[1])
+                fields['load15'] = float(load[2])
+            if self._stat is not None:
+                self._read_cpu(fields)
+            if self._meminfo is not None:
+                self._read_memory(fields)
+            if self._diskstats is not None:
+                self._read_disk(fields, now)
+            if self._throttled is not None:
+                flags = self._throttled.read_int(16)
+                fields['throttled'] = flags
+                fields['under_voltage'] = bool(flags & UNDER_VOLTAGE)
+                fields['freq_capped'] = bool(flags & FREQ_CAPPED)
+                fields['throttled_now'] = bool(flags & (THROTTLED | SOFT_TEMP_LIMIT))
+                fields['throttled_since_boot'] = bool(flags & THROTTLED_SINCE_BOOT)
+        return fields
+
+    def _read_cpu(self, fields):
+        # cpu  user nice system idle iowait irq softirq steal ...
+        line = self._stat.read().tobytes().split(b'\n', 1)[0]
+        ticks = [int(value) for value in line.split()[1:]]
+        idle = ticks[3] + ticks[4]
+        total = sum(ticks[:8])
+        if self._last_cpu is not None:
+            d_total = total - self._last_cpu[0]
+            if d_total > 0:
+                fields['cpu_busy_pct'] = 100 * (1 - (idle - self._last_cpu[1]) / d_total)
+                fields['cpu_iowait_pct'] = 100 * (ticks[4] - self._last_cpu[2]) / d_total
+        self._last_cpu = (total, idle, ticks[4])
+
+    def _read_memory(self, fields):
+        info = {}
+        for line in self._meminfo.read().tobytes().split(b'\n'):
+            key, _, value = line.partition(b':')
+            if key in (b'MemTotal', b'MemAvailable', b'SwapTotal', b'SwapFree'):
+                # kB
+                info[key] = int(value.split()[0])
+        if b'MemTotal' in info and b'MemAvailable' in info:
+            fields['mem_available_mb'] = info[b'MemAvailable'] / 1024
+            fields['mem_used_pct'] = 100 * (1 - info[b'MemAvailable'] / info[b'MemTotal'])
+        if b'SwapTotal' in info and b'SwapFree' in info:
+            fields['swap_used_mb'] = (info[b'SwapTotal'] - info[b'SwapFree']) / 1024
+
+    def _read_disk(self, fields, now):
+        for line in self._diskstats.read().tobytes().split(b'\n'):
+            parts = line.split()
+            if len(parts) > 13 and parts[2] == self.disk:
+                break
+        else:
+            return
+        # reads, sectors read, writes, sectors written, ms doing I/O
+        counters = (int(parts[3]), int(parts[5]), int(parts[7]), int(parts[9]),
+                    int(parts[12]))
+        if self._last_disk is not None:
+            last_time, last = self._last_disk
+            seconds = now - last_time
+            if seconds > 0:
+                fields['disk_read_iops'] = (counters[0] - last[0]) / seconds
+                fields['disk_read_kbps'] = (counters[1] - last[1]) / 2 / seconds
+                fields['disk_write_iops'] = (counters[2] - last[2]) / seconds
+                fields['disk_write_kbps'] = (counters[3] - last[3]) / 2 / seconds
+                fields['disk_busy_pct'] = (counters[4] - last[4]) / 10 / seconds
+        self._last_disk = (now, counters)
+
+    def close(self):
+        files = [zone for name, zone in self.zones] + [
+            self._loadavg, self._stat, self._meminfo, self._diskstats,
+            self._cpufreq, self._throttled]
+        for f in files:
+            if f is not None:
+                f.close()
+        self.zones = []
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def telemetry(disk=None):
+    '''
+    the HostTelemetry shared by every driver of the process, disk selects
+    the block device whose I/O is reported
+    '''
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = HostTelemetry(disk or 'mmcblk0')
+        elif disk is not None:
+            _telemetry.disk = disk.encode()
+        return _telemetry
+
+
+def cpu_temp():
+    return telemetry().cpu_temp()
+
+
+def bench(n=10000, disk='mmcblk0'):
+    '''
+    cost of a full read() and of re-reading the open files, against
+    opening and reading the same files each time
+    '''
+    host = HostTelemetry(disk)
+    host.read()
+    ts = time.perf_counter()
+    for _ in range(n):
+        fields = host.read()
+    read_us = (time.perf_counter() - ts) / n * 1e6
+    files = [zone for name, zone in host.zones] + [
+        f for f in (host._loadavg, host._stat, host._meminfo,
+                    host._diskstats, host._cpufreq, host._throttled)
+        if f is not None]
+    ts = time.perf_counter()
+    for _ in range(n):
+        for f in files:
+            f.read()
+    cached_us = (time.perf_counter() - ts) / n * 1e6
+    ts = time.perf_counter()
+    for _ in range(n):
+        for f in files:
+            with open(f.path, 'rb') as reopened:
+                reopened.read()
+    reopen_us = (time.perf_counter() - ts) / n * 1e6
+    host.close()
+    for key, value in sorted(fields.items()):
+        print('{:22} {}'.format(key, value))
+    print('read() {:.1f} us; reading the {} files {:.1f} us kept open, '
+          '{:.1f} us reopened'.format(read_us, len(files), cached_us, reopen_us))
+
+
+if __name__ == '__main__':
+    import sys
+    bench(disk=sys.argv[1] if len(sys.argv) > 1 else 'mmcblk0')
@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+import collections
+import logging
+import queue
+import threading
+import time
+
+import startup
+from line_protocol import Sample, encode_into
+from metrics import REGISTRY, SIZE_BUCKETS
+
+
+class InfluxWriter:
+    '''
+    one long lived InfluxDB client shared by an agent
+
+    the sampling loop hands Samples, points or line protocol str/bytes to
+    write(), they are queued and a background thread sends them in batches, either
+    when batch_size records are waiting or when the oldest one is
+    flush_interval seconds old, so the loop never waits on the network.
+    records are encoded straight into the buffer of the batch they go
+    out in, a full batch is kept as one bytes object
+
+    with a Spool attached, batches that cannot be written are appended to
+    it and replayed oldest first once the server answers again. only
+    outages are retried: a batch the server rejects with a 4xx other than
+    429 would fail the same way forever, so it is logged, counted and
+    dropped, spooled or not
+
+    influxdb_client takes seconds to import on a Pi, so the writer thread
+    imports it and builds the client while the drivers set up; records
+    queued meanwhile wait for it. if that fails (the server name does not
+    resolve yet at boot) it is tried again with every write retry. the
+    first records after start up are sent straight away instead of after
+    flush_interval
+    '''
+
+    def __init__(self, url, token, org, bucket, batch_size=500,
+                 flush_interval=10.0, max_pending=50000, pool_size=1,
+                 spool=None):
+        self._bucket = bucket
+        self._org = org
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._spool = spool
+        self._connect_args = dict(url=url, token=token, org=org,
+                                  connection_pool_maxsize=pool_size)
+        self._client = None
+        self._write_api = None
+        self._written = False
+        self._queue = queue.Queue()
+        # the batch being filled, the full ones waiting to be sent as
+        # (bytes, records) and the records in both
+        self._buf = bytearray()
+        self._buf_records = 0
+        self._batches = collections.deque()
+        self._pending = 0
+        self._oldest = None
+        self._retry_at = 0
+        # only ever touched by the signal handler and the writer thread,
+        # never by code that can be interrupted while holding the queue lock
+        self._flush_requested = threading.Event()
+        self._stopping = threading.Event()
+        # only updated on the writer thread
+        self._encode_time = REGISTRY.histogram(
+            'influx_encode_seconds', help='line protocol encoding of one record')
+        self._write_time = REGISTRY.histogram(
+            'influx_write_seconds', help='one batch write to InfluxDB')
+        self._batch_records = REGISTRY.histogram(
+            'influx_batch_records', buckets=SIZE_BUCKETS)
+        self._write_failures = REGISTRY.counter('influx_write_failures_total')
+        self._records_spooled = REGISTRY.counter('influx_spooled_records_total')
+        self._records_dropped = REGISTRY.counter('influx_dropped_records_total')
+        self._records_rejected = REGISTRY.counter(
+            'influx_rejected_records_total', help='records the server refused')
+        self._queue_depth = REGISTRY.gauge('influx_queue_depth')
+        self._thread = threading.Thread(
+            target=self._run, name='influx-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, records):
+        '''
+        queue a Sample, a Point, a line protocol str or bytes or a list of them,
+        never blocks
+        '''
+        # a Sample is a namedtuple, it must not be taken for a list
+        if isinstance(records, (list, tuple)) and not isinstance(records, Sample):
+            for record in records:
+                self._queue.put(record)
+        else:
+            self._queue.put(records)
+
+    def request_flush(self):
+        '''
+        ask the writer thread to send everything it holds as soon as
+        possible, safe to call from a signal handler
+        '''
+        self._flush_requested.set()
+
+    def flush(self, timeout=None):
+        '''
+        send everything queued so far and wait for the writer thread
+        '''
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=30):
+        '''
+        flush what is buffered, stop the writer thread and close the client
+        '''
+        if self._stopping.is_set():
+            return
+        self.flush(timeout)
+        self._stopping.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._spool is not None:
+            self._spool.close()
+        if self._client is not None:
+            self._client.close()
+        logging.info('Influx writer closed')
+
+    def _connect(self):
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS
+
+        # a single client keeps its urllib3 pool and the TCP/TLS session alive
+        client = InfluxDBClient(**self._connect_args)
+        try:
+            write_api = client.write_api(write_options=SYNCHRONOUS)
+        except Exception:
+            client.close()
+            raise
+        self._client = client
+        self._write_api = write_api
+        startup.mark('writer_ready')
+        logging.info('Influx writer connected')
+
+    def _run(self):
+        try:
+            self._connect()
+        except Exception:
+            # keep running: sends fail like writes to a server that is down,
+            # so the records are spooled and the client is created again
+            # on every retry until it works
+            logging.exception('Influx writer could not create its client')
+        while True:
+            try:
+                if self._step():
+                    return
+            except Exception:
+                # close() set _stopping before queueing None
+                if self._stopping.is_set() and self._queue.empty():
+                    logging.exception('Influx writer failed while closing')
+                    return
+                # a bad record or a broken spool must not end the thread
+                logging.exception('Influx writer failed, dropping the record')
+
+    def _step(self):
+        '''
+        take one item off the queue and send what is due, True on close()
+        '''
+        if self._oldest is None:
+            wait = 0.5
+        else:
+            wait = self._oldest + self._flush_interval - time.monotonic()
+            wait = min(max(wait, 0), 0.5)
+        try:
+            item = self._queue.get(timeout=wait)
+        except queue.Empty:
+            item = False
+            if (self._spool is not None and self._spool.pending_bytes and
+                    time.monotonic() >= self._retry_at):
+                self._send()
+
+        if item is None:
+            self._send(force=True)
+            if self._pending and self._spool is not None:
+                self._spool_pending()
+            return True
+        if isinstance(item, threading.Event):
+            try:
+                self._send(force=True)
+            finally:
+                item.set()
+            return False
+        if item is not False:
+            self._add(item)
+
+        if self._flush_requested.is_set():
+            self._flush_requested.clear()
+            self._send(force=True)
+        elif ((self._batches or not self._written) and
+              time.monotonic() >= self._retry_at):
+            self._send()
+        elif (self._oldest is not None and
+              time.monotonic() - self._oldest >= self._flush_interval):
+            self._send()
+        return False
+
+    def _add(self, record):
+        ts = time.perf_counter()
+        buf = self._buf
+        if isinstance(record, Sample):
+            if not encode_into(buf, record):
+                return
+        else:
+            if isinstance(record, str):
+                record = record.encode()
+            elif not isinstance(record, bytes):
+                record = record.to_line_protocol().encode()
+            if not record:
+                return
+            buf += record
+            buf += b'\n'
+        self._encode_time.observe_since(ts)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self._buf_records += 1
+        self._pending += 1
+        if self._buf_records >= self._batch_size:
+            self._seal()
+        if self._pending > self._max_pending and self._batches:
+            dropped = 0
+            while self._pending > self._max_pending and self._batches:
+                records = self._batches.popleft()[1]
+                self._pending -= records
+                dropped += records
+            self._records_dropped.inc(dropped)
+            logging.warning('Influx writer dropped {} records'.format(dropped))
+
+    def _seal(self):
+        '''
+        move the batch being filled to the ones waiting to be sent
+        '''
+        if self._buf_records:
+            self._batches.append((bytes(self._buf), self._buf_records))
+            del self._buf[:]
+            self._buf_records = 0
+
+    def _send(self, force=False):
+        if self._spool is not None and self._spool.pending_bytes:
+            # keep the order, nothing new goes out before the backlog
+            if not force and time.monotonic() < self._retry_at:
+                self._spool_pending()
+                return False
+            try:
+                self._spool.replay(self._replay_lines)
+            except Exception as error:
+                self._write_failed(error)
+                self._spool_pending()
+                return False
+
+        self._seal()
+        while self._batches:
+            data, records = self._batches[0]
+            try:
+                self._write_or_reject(data, records)
+            except Exception as error:
+                self._write_failed(error)
+                if self._spool is not None:
+                    self._spool_pending()
+                # otherwise keep the batch and retry on the next flush interval
+                return False
+            self._batches.popleft()
+            self._pending -= records
+        self._oldest = None
+        return True
+
+    def _replay_lines(self, lines):
+        self._write_or_reject(b'\n'.join(lines), len(lines))
+
+    def _write(self, data, records):
+        if self._write_api is None:
+            self._connect()
+        ts = time.perf_counter()
+        self._write_api.write(self._bucket, self._org, data)
+        if not self._written:
+            self._written = True
+            startup.mark('first_write')
+        self._write_time.observe_since(ts)
+        self._batch_records.observe(records)
+        self._queue_depth.set(self._queue.qsize())
+
+    def _write_or_reject(self, data, records):
+        '''
+        write the records in data, raise when the write should be retried
+        and drop them when the server refused them for good
+        '''
+        try:
+            self._write(data, records)
+        except Exception as error:
+            if _retryable(error):
+                raise
+            self._records_rejected.inc(records)
+            logging.error('Influx rejected {} records ({} bytes), dropping them: {} '
+                          '(first: {!r})'.format(records, len(data), error,
+                                                 bytes(data[:200]).split(b'\n')[0]))
+
+    def _write_failed(self, error):
+        logging.error('Influx write failed: {}'.format(error))
+        self._write_failures.inc()
+        self._oldest = time.monotonic()
+        self._retry_at = self._oldest + self._flush_interval
+
+    def _spool_pending(self):
+        self._seal()
+        self._records_spooled.inc(self._pending)
+        while self._batches:
+            self._spool.append_bytes(self._batches.popleft()[0])
+        self._pending = 0
+        self._oldest = None
+
+
+def _retryable(error):
+    '''
+    True for outages worth retrying: no HTTP answer at all (connection
+    errors, timeouts, no client), a 5xx or 429 too many requests
+    '''
+    status = getattr(error, 'status', None)
+    if not isinstance(status, int):
+        return True
+    return status == 429 or status >= 500 or status < 400
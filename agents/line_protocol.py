@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+import math
+import numbers
+from collections import namedtuple
+
+# one reading as the drivers emit it: measurement name, {field: value},
+# timestamp in integer nanoseconds and optional {tag: value}
+Sample = namedtuple("Sample", ["measurement", "fields", "time", "tags"])
+Sample.__new__.__defaults__ = (None,)
+
+
+def escape_measurement(name):
+    return name.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(key):
+    return key.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_value(value):
+    '''
+    the line protocol text of a field value, None for NaN and infinity,
+    which line protocol cannot carry
+    '''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else None
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _format_float(value):
+    value = float(value)
+    if not math.isfinite(value):
+        return None
+    return repr(value).encode()
+
+
+def _format_int(value):
+    return b'%di' % int(value)
+
+
+def _format_bool(value):
+    return b'true' if value else b'false'
+
+
+def _format_str(value):
+    return ('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"').encode()
+
+
+FORMATTERS = {
+    'float': _format_float,
+    'int': _format_int,
+    'bool': _format_bool,
+    'str': _format_str,
+}
+
+
+class Schema:
+    '''
+    compiled line protocol encoder for one measurement
+
+    the measurement, tag keys and field keys are escaped once, together
+    with the separators around them, and every field gets the formatter
+    of its declared type ("float", "int", "bool" or "str"), so encoding a
+    point is only formatting the values and the timestamp and appending
+    bytes to a buffer the caller reuses
+
+        schema = Schema("pool", {"ORP": "float", "pH": "float"}, tags=["site"])
+        buf = bytearray()
+        schema.encode_into(buf, {"ORP": 650.2, "pH": 7.4}, ts, {"site": "home"})
+
+    tags are written in sorted key order as InfluxDB prefers, fields that
+    are None, missing, NaN or infinite are left out and a point without
+    any field is not written at all
+    '''
+
+    def __init__(self, measurement, fields, tags=()):
+        self.measurement = measurement
+        self.prefix = escape_measurement(measurement).encode()
+        self.tags = [(key, (',' + escape_key(key) + '=').encode()) for key in sorted(tags)]
+        self.fields = []
+        for key, kind in fields.items():
+            escaped = escape_key(key)
+            self.fields.append((key, (' ' + escaped + '=').encode(),
+                                (',' + escaped + '=').encode(), FORMATTERS[kind]))
+
+    def encode_into(self, buf, fields, ts, tags=None):
+        '''
+        append the line (with a trailing newline) for the {field: value}
+        mapping at integer nanoseconds ts, returns False if it had no field
+        '''
+        start = len(buf)
+        buf += self.prefix
+        if tags:
+            for key, tag_key in self.tags:
+                value = tags.get(key)
+                if value is not None:
+                    buf += tag_key
+                    buf += escape_key(str(value)).encode()
+        first = True
+        for key, space_key, comma_key, fmt in self.fields:
+            value = fields.get(key)
+            if value is None:
+                continue
+            # None for values line protocol cannot carry
+            text = fmt(value)
+            if text is None:
+                continue
+            buf += space_key if first else comma_key
+            buf += text
+            first = False
+        if first:
+            del buf[start:]
+            return False
+        buf += b' %d\n' % ts
+        return True
+
+    def encode(self, fields, ts, tags=None):
+        '''
+        the line for one point as bytes, without the newline, b'' if it
+        had no field
+        '''
+        buf = bytearray()
+        if not self.encode_into(buf, fields, ts, tags):
+            return b''
+        return bytes(buf[:-1])
+
+
+# compiled schemas of the Samples seen so far, by measurement, field
+# names, value types and tag names; agents emit a handful of shapes
+_schemas = {}
+_TYPES = {bool: 'bool', int: 'int', float: 'float'}
+
+
+def _field_type(kind):
+    if kind in _TYPES:
+        return _TYPES[kind]
+    # numpy scalars and the like: numpy.bool_ is neither, so it is a str
+    if issubclass(kind, numbers.Integral):
+        return 'int'
+    if issubclass(kind, numbers.Real):
+        return 'float'
+    return 'str'
+
+
+def _schema(sample):
+    fields = sample.fields
+    tags = sample.tags
+    key = (sample.measurement, tuple(fields), tuple(map(type, fields.values())),
+           tuple(tags) if tags else ())
+    schema = _schemas.get(key)
+    if schema is None:
+        if len(_schemas) > 1000:
+            _schemas.clear()
+        types = {name: _field_type(kind) for name, kind in zip(key[1], key[2])
+                 if kind is not type(None)}
+        schema = _schemas[key] = Schema(key[0], types, key[3])
+    return schema
+
+
+def encode_into(buf, sample):
+    '''
+    append the line for a Sample, with its trailing newline, to the
+    bytearray buf through a cached Schema, returns False if it had no field
+    '''
+    return _schema(sample).encode_into(buf, sample.fields, sample.time, sample.tags)
+
+
+def encode(sample):
+    '''
+    line protocol bytes for a Sample through a cached Schema, fields that
+    are None, NaN or infinite are left out and a sample without any field
+    encodes to b''
+    '''
+    return _schema(sample).encode(sample.fields, sample.time, sample.tags)
+
+
+def encode_text(sample):
+    '''
+    line protocol for a Sample as a str, built without a Schema
+    '''
+    fields = []
+    for key, value in sample.fields.items():
+        if value is not None:
+            text = format_value(value)
+            if text is not None:
+                fields.append(escape_key(key) + '=' + text)
+    fields = ','.join(fields)
+    if not fields:
+        return ''
+    prefix = escape_measurement(sample.measurement)
+    if sample.tags:
+        for key in sorted(sample.tags):
+            prefix += ',' + escape_key(key) + '=' + escape_key(str(sample.tags[key]))
+    return '{} {} {}'.format(prefix, fields, sample.time)
+
+
+def bench(n=100000):
+    '''
+    cost per point of the compiled Schema, of encode_into(Sample) into one
+    batch buffer, of encode(Sample) and of the
+    influxdb_client Point when it is installed, run this file to print it
+    '''
+    import time
+    fields = {'ORP': 650.2, 'temp_c': 27.5, 'temp_f': 81.5, 'pH': 7.42,
+              'Water Level': 3.91}
+    ts = 1700000000000000000
+    schema = Schema('pool', {key: 'float' for key in fields})
+    buf = bytearray()
+    start = time.perf_counter()
+    for i in range(n):
+        schema.encode_into(buf, fields, ts + i)
+        if len(buf) > 65536:
+            del buf[:]
+    results = [('Schema.encode_into', time.perf_counter() - start)]
+    start = time.perf_counter()
+    for i in range(n):
+        encode_into(buf, Sample('pool', fields, ts + i))
+        if len(buf) > 65536:
+            del buf[:]
+    results.append(('encode_into(Sample)', time.perf_counter() - start))
+    start = time.perf_counter()
+    for i in range(n):
+        encode(Sample('pool', fields, ts + i))
+    results.append(('encode(Sample)', time.perf_counter() - start))
+    start = time.perf_counter()
+    for i in range(n):
+        encode_text(Sample('pool', fields, ts + i))
+    results.append(('encode_text(Sample)', time.perf_counter() - start))
+    try:
+        from influxdb_client import Point
+    except ImportError:
+        Point = None
+    if Point is not None:
+        start = time.perf_counter()
+        for i in range(n):
+            point = Point('pool')
+            for key, value in fields.items():
+                point.field(key, value)
+            point.time(ts + i).to_line_protocol()
+        results.append(('Point.to_line_protocol', time.perf_counter() - start))
+    for name, seconds in results:
+        print('{:24} {:6.2f} us/point'.format(name, seconds / n * 1e6))
+
+
+if __name__ == '__main__':
+    import sys
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,491 @@
+#!/usr/bin/python3
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from line_protocol import Sample
+from metrics import REGISTRY
+
+MAGIC = b'PFRING01'
+# magic, capacity in records, records ever appended, length of the JSON meta
+HEADER = struct.Struct('<8sQQI')
+WRITTEN_OFFSET = 16
+# the JSON meta follows HEADER, records start at the next page
+HEADER_BYTES = 4096
+TIME = struct.Struct('<q')
+
+# multipliers of the relative times accepted by queries, "-5m"
+UNITS = {'s': 10**9, 'm': 60 * 10**9, 'h': 3600 * 10**9, 'd': 86400 * 10**9}
+
+
+class Ring:
+    '''
+    fixed size records of one series in a memory-mapped ring file
+
+    a record is the int64 time in ns followed by one float64 per field,
+    NaN for a missing value, so record i lives at a fixed offset and the
+    file never grows. the header keeps the count of records ever appended;
+    the last `capacity` of them are in the file, oldest first from slot
+    written % capacity. appends are in time order, so the ring itself is
+    the time index and queries bisect it
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.last_time = None
+
+    @classmethod
+    def create(cls, path, measurement, tags, fields, ring_bytes):
+        '''
+        a new empty ring of about ring_bytes for the numeric fields
+        '''
+        ring = cls(path)
+        ring._create(measurement, tags, fields, ring_bytes)
+        return ring
+
+    @classmethod
+    def open(cls, path):
+        ring = cls(path)
+        ring._open()
+        if ring.written:
+            ring.last_time = ring._time_at(ring.written - 1)
+        return ring
+
+    def _create(self, measurement, tags, fields, ring_bytes):
+        path = self.path
+        self.measurement = measurement
+        self.tags = tags
+        self.fields = list(fields)
+        self.record = struct.Struct('<q' + 'd' * len(self.fields))
+        meta = json.dumps({'measurement': measurement, 'tags': tags,
+                           'fields': self.fields}).encode()
+        if HEADER.size + len(meta) > HEADER_BYTES:
+            raise ValueError('too many fields for a ring header')
+        self.capacity = max(1, (ring_bytes - HEADER_BYTES) // self.record.size)
+        self.written = 0
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.truncate(HEADER_BYTES + self.capacity * self.record.size)
+            f.write(HEADER.pack(MAGIC, self.capacity, 0, len(meta)) + meta)
+        os.replace(tmp, path)
+        self._map()
+
+    def _open(self):
+        self._map()
+        magic, self.capacity, self.written, length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a ring file'.format(self.path))
+        meta = json.loads(self.map[HEADER.size:HEADER.size + length].decode())
+        self.measurement = meta['measurement']
+        self.tags = meta['tags']
+        self.fields = meta['fields']
+        self.record = struct.Struct('<q' + 'd' * len(self.fields))
+
+    def _map(self):
+        self._file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self._file.fileno(), 0)
+
+    @property
+    def size(self):
+        return HEADER_BYTES + self.capacity * self.record.size
+
+    def _offset(self, index):
+        return HEADER_BYTES + (index % self.capacity) * self.record.size
+
+    def _time_at(self, index):
+        return TIME.unpack_from(self.map, self._offset(index))[0]
+
+    def append(self, ts, values):
+        '''
+        store a record, values in the order of fields; False when it is
+        older than the last one
+        '''
+        with self.lock:
+            if self.last_time is not None and ts < self.last_time:
+                return False
+            self.record.pack_into(self.map, self._offset(self.written), ts, *values)
+            self.written += 1
+            # the count last, a reader never sees a slot that is not written
+            struct.pack_into('<Q', self.map, WRITTEN_OFFSET, self.written)
+            self.last_time = ts
+            return True
+
+    def _bisect(self, ts, lo, hi, right=False):
+        # first index in [lo, hi) with time >= ts (> ts with right)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self._time_at(mid)
+            if t < ts or (right and t == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _records(self, first, last, step=1):
+        if step > 1:
+            return [self.record.unpack_from(self.map, self._offset(i))
+                    for i in range(first, last, step)]
+        # at most two runs of contiguous slots, unpacked in one go each
+        records = []
+        while first < last:
+            slot = first % self.capacity
+            count = min(last - first, self.capacity - slot)
+            start = HEADER_BYTES + slot * self.record.size
+            records.extend(self.record.iter_unpack(
+                self.map[start:start + count * self.record.size]))
+            first += count
+        return records
+
+    def latest(self):
+        '''
+        the newest record as (time, values), None when empty
+        '''
+        with self.lock:
+            if not self.written:
+                return None
+            record = self.record.unpack_from(self.map, self._offset(self.written - 1))
+        return record[0], record[1:]
+
+    def range(self, start, end, limit):
+        '''
+        records with start <= time <= end as (time, *values) tuples, every
+        step-th one when there are more than limit, returns (records, step)
+        '''
+        with self.lock:
+            lo = max(0, self.written - self.capacity)
+            first = self._bisect(start, lo, self.written)
+            last = self._bisect(end, first, self.written, right=True)
+            step = max(1, math.ceil((last - first) / limit))
+            return self._records(first, last, step), step
+
+    def info(self):
+        with self.lock:
+            count = min(self.written, self.capacity)
+            first = self._time_at(self.written - count) if count else None
+            last = self.last_time
+        return {'measurement': self.measurement, 'tags': self.tags,
+                'fields': self.fields, 'records': count,
+                'capacity': self.capacity, 'first': first, 'last': last}
+
+    def copy(self, other):
+        '''
+        append the records other still holds, oldest first, with NaN for
+        the fields this ring has after those of other; only the newest
+        ones when they do not all fit
+        '''
+        with other.lock:
+            count = min(other.written, other.capacity, self.capacity)
+            records = other._records(other.written - count, other.written)
+        pad = (math.nan,) * (len(self.fields) - len(other.fields))
+        with self.lock:
+            for record in records:
+                self.record.pack_into(self.map, self._offset(self.written),
+                                      *record, *pad)
+                self.written += 1
+            struct.pack_into('<Q', self.map, WRITTEN_OFFSET, self.written)
+            if records:
+                self.last_time = records[-1][0]
+
+    def flush(self):
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            # a query still holding the ring sees it empty from now on
+            self.written = 0
+            self.map.close()
+            self._file.close()
+
+
+def _series_key(measurement, tags):
+    return measurement, tuple(sorted(tags.items())) if tags else ()
+
+
+def _number(value):
+    if value is None or isinstance(value, str):
+        return None
+    return float(value)
+
+
+class LocalStore:
+    '''
+    host pipeline stage keeping the recent samples of every series on the
+    Pi, so they can be queried without InfluxDB
+
+    each series (measurement and tags) gets a Ring file of ring_bytes in
+    directory holding its numeric fields, bools as 0/1; strings are not
+    stored. retention is bounded by size: a ring overwrites its oldest
+    records, and new series are refused once the rings would take more
+    than max_bytes. a series that starts sending a field its ring does not
+    have gets a new ring with the wider schema and the old records copied
+    over, as many of the newest as the wider records leave room for.
+    the store is the first stage, so it sees every sample before any
+    downsampling or deadband filtering. samples pass through unchanged
+
+    config (the host's "store" key):
+
+        {"directory": "<next to the log by default>",
+         "ring_bytes": 4194304, "max_bytes": 67108864,
+         "port": 9102, "host": "127.0.0.1"}
+
+    with a port, serve() answers JSON queries, see make_handler()
+    '''
+
+    def __init__(self, directory, ring_bytes=4 * 1024 * 1024,
+                 max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.ring_bytes = ring_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._rings = {}
+        self._refused = set()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.ring'):
+                continue
+            try:
+                ring = Ring.open(os.path.join(directory, name))
+            except (OSError, ValueError) as error:
+                logging.warning('Skipping local store file {}: {}'.format(name, error))
+                continue
+            self._rings[_series_key(ring.measurement, ring.tags)] = ring
+        self._out_of_order = REGISTRY.counter(
+            'store_out_of_order_total', help='samples older than the last one of their series')
+        self._refused_samples = REGISTRY.counter(
+            'store_refused_total', help='samples of series over the store size limit')
+        if self._rings:
+            logging.info('Local store {} holds {} series'.format(directory, len(self._rings)))
+
+    @classmethod
+    def from_config(cls, config, default_directory):
+        return cls(config.get('directory') or default_directory,
+                   config.get('ring_bytes', 4 * 1024 * 1024),
+                   config.get('max_bytes', 64 * 1024 * 1024))
+
+    def _path(self, key):
+        measurement, tags = key
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', measurement)
+        if tags:
+            name += '-' + hashlib.sha1(repr(tags).encode()).hexdigest()[:8]
+        return os.path.join(self.directory, name + '.ring')
+
+    def _ring(self, key, numeric):
+        ring = self._rings.get(key)
+        if ring is not None and all(field in ring.fields for field in numeric):
+            return ring
+        if ring is None:
+            fields = sorted(numeric)
+            used = sum(r.size for r in self._rings.values())
+            if used + self.ring_bytes > self.max_bytes:
+                if key not in self._refused:
+                    self._refused.add(key)
+                    logging.warning('Local store full, not keeping {} {}'.format(
+                        key[0], dict(key[1]) or ''))
+                return None
+        else:
+            # new fields last, so the old records only need NaN appended
+            fields = ring.fields + sorted(set(numeric) - set(ring.fields))
+            logging.warning('Local store widens {} to fields {}'.format(
+                ring.path, ', '.join(fields)))
+        # queries find the old ring or the new one filled with its records
+        with self._lock:
+            new = Ring.create(self._path(key), key[0], dict(key[1]), fields,
+                              self.ring_bytes)
+            if ring is not None:
+                new.copy(ring)
+                ring.close()
+            self._rings[key] = new
+        return new
+
+    def append(self, sample):
+        numeric = {field: _number(value) for field, value in sample.fields.items()}
+        numeric = {field: value for field, value in numeric.items() if value is not None}
+        if not numeric:
+            return
+        key = _series_key(sample.measurement, sample.tags)
+        if key in self._refused:
+            self._refused_samples.inc()
+            return
+        ring = self._ring(key, numeric)
+        if ring is None:
+            self._refused_samples.inc()
+            return
+        values = [numeric.get(field, math.nan) for field in ring.fields]
+        if not ring.append(sample.time, values):
+            self._out_of_order.inc()
+
+    def process(self, samples):
+        for sample in samples:
+            if isinstance(sample, Sample):
+                self.append(sample)
+        return samples
+
+    def flush(self):
+        with self._lock:
+            rings = list(self._rings.values())
+        for ring in rings:
+            ring.flush()
+        return []
+
+    def find(self, measurement, tags=None):
+        '''
+        the rings of measurement whose tags include tags
+        '''
+        with self._lock:
+            rings = list(self._rings.values())
+        return [ring for ring in rings if ring.measurement == measurement and
+                all((ring.tags or {}).get(k) == v for k, v in (tags or {}).items())]
+
+    def series(self):
+        with self._lock:
+            rings = list(self._rings.values())
+        return [ring.info() for ring in rings]
+
+
+def parse_time(value, now):
+    '''
+    ns since the epoch from an integer of ns, "now" or a time relative to
+    now such as "-5m", "-2h" or "-30" (seconds)
+    '''
+    if value == 'now':
+        return now
+    if value.startswith('-'):
+        if value[-1] in UNITS:
+            return now - int(float(value[1:-1]) * UNITS[value[-1]])
+        return now - int(float(value[1:]) * 10**9)
+    return int(value)
+
+
+def _point(ts, fields, values, wanted):
+    point = {'time': ts}
+    for field, value in zip(fields, values):
+        if (wanted is None or field in wanted) and value == value:
+            point[field] = value
+    return point
+
+
+def query(store, path, params):
+    '''
+    answer one query as (status, JSON-able body)
+
+        /series                                     every series with its time span
+        /latest?measurement=pool[&fields=pH,ORP]    newest record of each series
+        /range?measurement=pool&start=-5m[&end=now][&fields=pH][&limit=1000]
+
+    other parameters filter on tags, e.g. &sensor=attic. range returns at
+    most limit points per series, every step-th record when there are more
+    '''
+    if path == '/series':
+        return 200, {'series': store.series()}
+    if path not in ('/latest', '/range'):
+        return 404, {'error': 'unknown path {}'.format(path)}
+    params = dict(params)
+    measurement = params.pop('measurement', None)
+    if not measurement:
+        return 400, {'error': 'measurement is required'}
+    wanted = params.pop('fields', None)
+    wanted = set(wanted.split(',')) if wanted else None
+    try:
+        now = time.time_ns()
+        start = parse_time(params.pop('start', '-1h'), now)
+        end = parse_time(params.pop('end', 'now'), now)
+        limit = max(1, int(params.pop('limit', 1000)))
+    except ValueError as error:
+        return 400, {'error': str(error)}
+    rings = store.find(measurement, params)
+    if not rings:
+        return 404, {'error': 'no series {} {}'.format(measurement, params or '')}
+    series = []
+    for ring in rings:
+        entry = {'measurement': ring.measurement, 'tags': ring.tags}
+        if path == '/latest':
+            latest = ring.latest()
+            entry['point'] = latest and _point(latest[0], ring.fields, latest[1], wanted)
+        else:
+            records, step = ring.range(start, end, limit)
+            entry['step'] = step
+            entry['points'] = [_point(record[0], ring.fields, record[1:], wanted)
+                               for record in records]
+        series.append(entry)
+    return 200, {'series': series}
+
+
+def serve(store, port, host='127.0.0.1'):
+    '''
+    serve the store queries on http://host:port from a daemon thread,
+    returns the server so it can be shut down
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl, urlsplit
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            status, body = query(store, url.path.rstrip('/') or '/',
+                                 parse_qsl(url.query))
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='store-http',
+                     daemon=True).start()
+    return server
+
+
+def bench(records=1000000):
+    '''
+    fill a scratch store with a week of pool samples at 10 s and more,
+    time the appends and the latest and range queries
+    '''
+    import tempfile
+    fields = {'ORP': 650.2, 'temp_c': 27.5, 'temp_f': 81.5, 'pH': 7.42,
+              'Water Level': 3.91}
+    now = time.time_ns()
+    first = now - records * 10 * 10**9
+    with tempfile.TemporaryDirectory() as directory:
+        store = LocalStore(directory, ring_bytes=HEADER_BYTES + records * 48)
+        ts = time.perf_counter()
+        for i in range(records):
+            store.append(Sample('pool', fields, first + i * 10 * 10**9))
+        append_us = (time.perf_counter() - ts) / records * 1e6
+        print('append {:.1f} us per sample, {} MB'.format(
+            append_us, sum(r.size for r in store._rings.values()) // 2**20))
+        for path, params in (('/latest', {}),
+                             ('/range', {'start': '-5m'}),
+                             ('/range', {'start': '-1d', 'limit': '10000'}),
+                             ('/range', {'start': '-30d', 'limit': '1000'})):
+            params = dict(params, measurement='pool')
+            n = 200
+            ts = time.perf_counter()
+            for _ in range(n):
+                status, body = query(store, path, params)
+            ms = (time.perf_counter() - ts) / n * 1e3
+            points = body['series'][0].get('points')
+            print('{} {} {:.3f} ms{}'.format(
+                path, params.get('start', ''), ms,
+                '' if points is None else ', {} points'.format(len(points))))
+        for ring in store._rings.values():
+            ring.close()
+
+
+if __name__ == '__main__':
+    import sys
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
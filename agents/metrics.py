@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+import threading
+import time
+from bisect import bisect_left
+
+from line_protocol import Sample
+
+# upper bounds in seconds, from 100 us to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# records per batch
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 250, 500, 1000, 5000)
+
+
+class Counter:
+    '''
+    monotonically increasing count
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, labels, help):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def fields(self):
+        return {'value': self.value}
+
+    def exposition(self, labels):
+        return ['{}{} {}'.format(self.name, labels(), self.value)]
+
+
+class Gauge(Counter):
+    '''
+    value that goes up and down, set() by its owner
+    '''
+
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    '''
+    counts of observations in fixed buckets plus their sum, the bucket
+    bounds are upper bounds as in Prometheus
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, labels, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.buckets = tuple(buckets)
+        # last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def observe_since(self, start):
+        '''
+        observe the time since start, a time.perf_counter() value
+        '''
+        self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        '''
+        upper bound of the bucket holding the q quantile, None when empty
+        or when it falls in the +Inf bucket
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def fields(self):
+        fields = {'count': self.count, 'sum': self.sum}
+        if self.count:
+            fields['mean'] = self.sum / self.count
+            fields['p50'] = self.quantile(0.5)
+            fields['p99'] = self.quantile(0.99)
+        return fields
+
+    def exposition(self, labels):
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append('{}_bucket{} {}'.format(self.name, labels(le=bound), seen))
+        lines.append('{}_bucket{} {}'.format(self.name, labels(le='+Inf'), self.count))
+        lines.append('{}_sum{} {}'.format(self.name, labels(), self.sum))
+        lines.append('{}_count{} {}'.format(self.name, labels(), self.count))
+        return lines
+
+
+class Registry:
+    '''
+    the metrics of one agent process, keyed by name and labels
+
+    counter(), gauge() and histogram() return the existing metric when it
+    was created before, so modules can look them up once at setup and keep
+    the object. observing takes no lock to stay well under a microsecond,
+    so every metric must only be updated from one thread; metrics of
+    different drivers are told apart by labels anyway. readers may see a
+    histogram mid update, off by one observation
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels, help, *args):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, dict(key[1]), help, *args)
+            return metric
+
+    def counter(self, name, labels=None, help=''):
+        return self._get(Counter, name, labels, help)
+
+    def gauge(self, name, labels=None, help=''):
+        return self._get(Gauge, name, labels, help)
+
+    def histogram(self, name, labels=None, help='', buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, labels, help, buckets)
+
+    def samples(self, measurement='agent_metrics', tags=None):
+        '''
+        one Sample per metric, tagged with its name and labels
+
+        every value is written as a float: counters and gauges share the
+        value field and InfluxDB refuses a field whose type changes within
+        a shard
+        '''
+        now = time.time_ns()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        out = []
+        for metric in metrics:
+            sample_tags = dict(tags or {})
+            sample_tags.update(metric.labels)
+            sample_tags['metric'] = metric.name
+            fields = {key: float(value) for key, value in metric.fields().items()
+                      if value is not None}
+            out.append(Sample(measurement, fields, now, sample_tags))
+        return out
+
+    def exposition(self):
+        '''
+        all metrics in the Prometheus text format
+        '''
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        previous = None
+        for metric in metrics:
+            if metric.name != previous:
+                previous = metric.name
+                if metric.help:
+                    lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+
+            def labels(metric=metric, **extra):
+                pairs = list(metric.labels.items()) + list(extra.items())
+                if not pairs:
+                    return ''
+                return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+            lines.extend(metric.exposition(labels))
+        return '\n'.join(lines) + '\n'
+
+
+# the process wide registry used by the agents
+REGISTRY = Registry()
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    '''
+    serve the registry on http://host:port/metrics from a daemon thread,
+    returns the server so it can be shut down
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http',
+                     daemon=True).start()
+    return server
+
+
+def field_type_conflicts(samples):
+    '''
+    {(measurement, field): types} for the fields written with more than
+    one value type across samples
+    '''
+    types = {}
+    for sample in samples:
+        for key, value in sample.fields.items():
+            types.setdefault((sample.measurement, key), set()).add(type(value).__name__)
+    return {key: kinds for key, kinds in types.items() if len(kinds) > 1}
+
+
+def check(registry=None):
+    '''
+    fill a registry with every kind of metric and fail when its samples
+    mix value types for one field
+    '''
+    if registry is None:
+        registry = Registry()
+        registry.counter('check_total').inc(3)
+        registry.gauge('check_depth').set(2)
+        registry.gauge('check_seconds').set(0.25)
+        registry.histogram('check_latency_seconds').observe(0.003)
+        registry.histogram('check_records', buckets=SIZE_BUCKETS).observe(7)
+        registry.histogram('check_empty_seconds')
+    conflicts = field_type_conflicts(registry.samples())
+    for (measurement, key), kinds in sorted(conflicts.items()):
+        print('{} field {} written as {}'.format(measurement, key, ', '.join(sorted(kinds))))
+    return not conflicts
+
+
+def bench(n=1000000):
+    '''
+    cost of one observation, run this file to print it
+    '''
+    registry = Registry()
+    counter = registry.counter('bench_total')
+    histogram = registry.histogram('bench_seconds')
+    ts = time.perf_counter()
+    for _ in range(n):
+        counter.inc()
+    counter_ns = (time.perf_counter() - ts) / n * 1e9
+    ts = time.perf_counter()
+    for i in range(n):
+        histogram.observe(0.003)
+    observe_ns = (time.perf_counter() - ts) / n * 1e9
+    ts = time.perf_counter()
+    for _ in range(n):
+        histogram.observe_since(ts)
+    since_ns = (time.perf_counter() - ts) / n * 1e9
+    print('counter.inc {:.0f} ns, histogram.observe {:.0f} ns, '
+          'histogram.observe_since {:.0f} ns'.format(counter_ns, observe_ns, since_ns))
+
+
+if __name__ == '__main__':
+    import sys
+    if not check():
+        sys.exit(1)
+    bench()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+import time
+
+SKIP = 'skip'
+COALESCE = 'coalesce'
+
+
+class Schedule:
+    '''
+    fixed rate sampling ticks on an absolute grid of the monotonic clock
+
+    tick k is due at start + k * interval, however long the work of the
+    previous tick took, so the period does not stretch by the read and
+    network time. with align the grid is placed on multiples of interval
+    in wall clock time (a 10 s schedule ticks at :00, :10, ...), which
+    lines the samples up with the downsampling windows
+
+    a tick taken a whole interval or more late has overrun: the grid
+    points that passed are counted in overruns and dropped, the schedule
+    never bursts to catch up. with policy "coalesce" the late tick still
+    fires once, with "skip" it is dropped too and the next sample waits
+    for the next grid point
+
+    interval 0 is due all the time, for drivers that pace themselves
+    '''
+
+    def __init__(self, interval, policy=COALESCE, align=True):
+        if policy not in (SKIP, COALESCE):
+            raise ValueError('unknown schedule policy {!r}'.format(policy))
+        self.interval = interval
+        self.policy = policy
+        self.next_time = time.monotonic()
+        if interval > 0 and align:
+            self.next_time += -time.time() % interval
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def due(self, now):
+        return now >= self.next_time
+
+    def fire(self, now):
+        '''
+        take the due tick at monotonic time now, False when it is skipped
+        '''
+        if self.interval <= 0:
+            self.next_time = now
+            self.ticks += 1
+            return True
+        missed = int((now - self.next_time) // self.interval)
+        self.next_time += (missed + 1) * self.interval
+        if missed > 0:
+            self.overruns += missed
+            if self.policy == SKIP:
+                self.skipped += 1
+                return False
+        self.ticks += 1
+        return True
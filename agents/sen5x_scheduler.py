@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+import math
+import time
+
+from metrics import REGISTRY
+
+
+class Sen5xScheduler:
+    '''
+    waits for SEN5x results without busy polling the data ready flag
+
+    the sensor produces a result every period seconds. after a result was
+    seen, the next data ready check is scheduled margin seconds before the
+    next one is due; if it is not ready yet the check is repeated with a
+    backoff that doubles from backoff_start up to backoff_max. because every
+    wait is measured from the last observed result, the schedule follows
+    the sensor clock instead of drifting against it
+
+    status_due() spaces the slower device status reads status_interval
+    seconds apart. stats() reports checks per sample and the jitter of the
+    interval between results, which also goes to the sen5x_jitter_seconds
+    histogram
+    '''
+
+    def __init__(self, device, period=1.0, margin=0.005, backoff_start=0.005,
+                 backoff_max=0.2, status_interval=60, timeout=5.0):
+        self.device = device
+        self.period = period
+        self.margin = margin
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.status_interval = status_interval
+        self.timeout = timeout
+        self._last_ready = None
+        self._last_status = None
+        self.samples = 0
+        self.checks = 0
+        self.misses = 0
+        # running mean and variance of (interval - period), Welford
+        self._jitter_n = 0
+        self._jitter_mean = 0.0
+        self._jitter_m2 = 0.0
+        self.jitter_max = 0.0
+        self._jitter_time = REGISTRY.histogram(
+            'sen5x_jitter_seconds',
+            help='deviation of the interval between results from period')
+
+    def wait_ready(self):
+        '''
+        block until the sensor has a new result, False on timeout
+        '''
+        now = time.monotonic()
+        if self._last_ready is not None:
+            due = self._last_ready + self.period - self.margin
+            if due > now:
+                time.sleep(due - now)
+        deadline = time.monotonic() + self.timeout
+        backoff = self.backoff_start
+        while True:
+            self.checks += 1
+            if self.device.read_data_ready():
+                break
+            self.misses += 1
+            if time.monotonic() >= deadline:
+                self._last_ready = None
+                return False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.backoff_max)
+
+        now = time.monotonic()
+        if self._last_ready is not None:
+            self._add_jitter(now - self._last_ready - self.period)
+        self._last_ready = now
+        self.samples += 1
+        return True
+
+    def status_due(self):
+        now = time.monotonic()
+        if self._last_status is None or now - self._last_status >= self.status_interval:
+            self._last_status = now
+            return True
+        return False
+
+    def _add_jitter(self, deviation):
+        self._jitter_n += 1
+        delta = deviation - self._jitter_mean
+        self._jitter_mean += delta / self._jitter_n
+        self._jitter_m2 += delta * (deviation - self._jitter_mean)
+        self.jitter_max = max(self.jitter_max, abs(deviation))
+        self._jitter_time.observe(abs(deviation))
+
+    def stats(self):
+        '''
+        checks per sample and interval jitter in seconds since start
+        '''
+        std = 0.0
+        if self._jitter_n > 1:
+            std = math.sqrt(self._jitter_m2 / (self._jitter_n - 1))
+        return {
+            'samples': self.samples,
+            'checks_per_sample': self.checks / max(self.samples, 1),
+            'misses': self.misses,
+            'jitter_mean': self._jitter_mean,
+            'jitter_std': std,
+            'jitter_max': self.jitter_max,
+        }
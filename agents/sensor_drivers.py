@@ -0,0 +1,504 @@
+#!/usr/bin/python3
+import json
+import logging
+import os
+import threading
+import time
+
+import host_telemetry
+from agent_host import SensorDriver
+from dht_sampler import DhtSampler
+from emporia_fan import FakeVueBackend, VueOutletClient
+from fan_control import FanController
+from line_protocol import Sample
+from metrics import REGISTRY
+
+
+class PoolDriver(SensorDriver):
+    '''
+    Atlas EZO ORP, pH and temperature circuits on I2C plus the Teensy water
+    level stream on serial, written to the "pool" measurement
+
+    config keys: interval, serial, binary (BINARY_FRAMES Teensy build),
+    device_cache, backend, record, replay (see SensorDriver)
+    '''
+
+    name = 'pool'
+    default_interval = 10
+
+    def open_devices(self):
+        binary = self.config.get('binary', False)
+        backend = self.config.get('backend', 'hardware')
+        if backend == 'hardware':
+            import serial
+            from AtlasI2C import AtlasI2C
+
+            self._atlas = AtlasI2C
+            self.ser = serial.Serial(self.config.get('serial', '/dev/ttyACM0'),
+                                     baudrate=115200 if binary else 9600,
+                                     timeout=1)  # open serial port
+        else:
+            import fake_devices
+
+            if backend == 'replay':
+                bus = fake_devices.FakeI2CBus.replay(self.config['replay'])
+                self.ser = fake_devices.FakeSerial(events=fake_devices.load_recording(
+                    self.config['replay'], 'serial'))
+            else:
+                bus = fake_devices.FakeI2CBus.pool()
+                self.ser = fake_devices.FakeSerial(binary=binary)
+            self._atlas = fake_devices.atlas_class(bus)
+        if self.config.get('record'):
+            import fake_devices
+
+            rec = fake_devices.recorder(self.config['record'])
+            self._atlas = fake_devices.recording_atlas_class(self._atlas, rec)
+            self.ser = fake_devices.RecordingSerial(self.ser, rec)
+
+    def setup(self):
+        # asyncio only for the pool, the other agents start without it
+        import asyncio
+        from teensy_serial import SerialSampler
+
+        # addresses, module types and names of the Atlas circuits found last time
+        self.device_cache = self.config.get('device_cache') or os.path.join(
+            self.state_dir, 'atlas_devices.json')
+        binary = self.config.get('binary', False)
+        self.open_devices()
+        self.device_list = self.get_devices()
+        self.print_devices(self.device_list, self.device_list[0])
+        self.sampler = SerialSampler(self.ser, binary=binary)
+        self.sampler.start()
+        self.loop = asyncio.new_event_loop()
+        self.i2c_time = REGISTRY.histogram(
+            'i2c_wait_seconds', {'driver': self.name},
+            help='time waiting on I2C sensor results')
+
+    def load_device_cache(self, bus, addresses):
+        '''
+        return the cached [address, moduletype, name] entries if the cache was
+        written for this bus and exactly these addresses answered the scan
+        '''
+        try:
+            with open(self.device_cache, 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cached.get('bus') != bus:
+            return None
+        if [entry[0] for entry in cached.get('devices', [])] != addresses:
+            logging.info('Atlas device cache is stale, rescanning')
+            return None
+        return cached['devices']
+
+    def save_device_cache(self, bus, devices):
+        try:
+            tmp = self.device_cache + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'bus': bus, 'devices': devices}, f)
+            os.replace(tmp, self.device_cache)
+        except IOError as error:
+            logging.warning('Cannot write Atlas device cache: {}'.format(error))
+
+    def get_devices(self):
+        device = self._atlas()
+        device_address_list = device.list_i2c_devices()
+        devices = self.load_device_cache(device.bus, device_address_list)
+
+        if devices is None:
+            devices = []
+            for i in device_address_list:
+                device.set_i2c_address(i)
+                response = device.query("I")
+                moduletype = response.split(",")[1]
+                response = device.query("name,?").split(",")[1]
+                devices.append([i, moduletype, response])
+            self.save_device_cache(device.bus, devices)
+        device.close()
+
+        return [self._atlas(address=i, moduletype=moduletype, name=name)
+                for i, moduletype, name in devices]
+
+    def print_devices(self, device_list, device):
+        for i in device_list:
+            if (i == device):
+                logging.info("--> " + i.get_device_info())
+            else:
+                logging.info(" - " + i.get_device_info())
+
+    async def read_devices(self):
+        '''
+        start a reading on every circuit at once, each one is read as soon as
+        its own conversion time has passed
+        '''
+        import asyncio
+
+        return await asyncio.gather(*[dev.async_query_result("R")
+                                      for dev in self.device_list])
+
+    def sample(self):
+        # every circuit starts its conversion now
+        current_time = time.time_ns()
+        ts = time.perf_counter()
+        readings = self.loop.run_until_complete(self.read_devices())
+        self.i2c_time.observe_since(ts)
+        failed = [r for r in readings if r.value is None]
+        if failed:
+            for r in failed:
+                logging.error('Atlas device {} returned status {}'.format(
+                    r.address, r.status))
+            return []
+        ORP = readings[0].value
+        pH = readings[1].value
+        Temperature = readings[2].value
+        # average of every reading the Teensy sent during this interval
+        stats = self.sampler.aggregate()
+        if stats is None:
+            logging.warning('No water level reading in the last interval')
+            waterlevel = None
+        else:
+            waterlevel = stats.mean*2/(-66) + 3.8 + 666/66
+
+        logging.info('pushing to DB ORP = ' + str(ORP) + ' Temperature = ' +
+                     str(Temperature) + ' pH = ' + str(pH))
+        return [
+            Sample("pool", {"ORP": ORP,
+                            "temp_c": Temperature,
+                            "temp_f": (Temperature * 1.8) + 32,
+                            "pH": pH,
+                            "Water Level": waterlevel}, current_time),
+            Sample("host", {"cpu_temp_c": host_telemetry.cpu_temp()}, current_time),
+        ]
+
+    def close(self):
+        self.sampler.stop()
+        self.loop.close()
+        for device in self.device_list:
+            device.close()
+        self.ser.close()
+
+
+class AtticDriver(SensorDriver):
+    '''
+    DHT22 temperature and humidity plus the attic fan on an Emporia Vue
+    outlet, written to the "DHT22", "CPU" and "FAN" measurements
+
+    the fan is driven by a FanController (fan_control.py) from the DHT22
+    temperature; the outlet state is read back from the cloud at setup and
+    every fan_reconcile_interval seconds
+
+    the DHT22 goes through a DhtSampler (dht_sampler.py) that retries
+    within the sampling slot and drops glitches; its read counters are
+    written to "DHT22_reads" every dht_stats_interval seconds
+
+    config keys: interval, pin, backend, record, replay (see
+    SensorDriver), dht_window, dht_stats_interval, turn_on_temp,
+    turn_off_temp, attic_gid, vue_username, vue_password, vue_tokenfile,
+    vue_backend ("fake" for a local FakeVueBackend, the default with a
+    fake or replay backend), fan_time_constant, fan_min_on, fan_min_off,
+    fan_min_switch_interval, fan_reconcile_interval
+    '''
+
+    name = 'attic'
+    default_interval = 5
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.attic_gid = config.get('attic_gid', 41020)
+        self.vue_username = config.get('vue_username')
+        self.vue_password = config.get('vue_password')
+        self.vue_tokenfile = config.get('vue_tokenfile')
+        self.fan = FanController(
+            config.get('turn_on_temp', 37), config.get('turn_off_temp', 35),
+            time_constant=config.get('fan_time_constant', 30),
+            min_on=config.get('fan_min_on', 300),
+            min_off=config.get('fan_min_off', 300),
+            min_switch_interval=config.get('fan_min_switch_interval', 120),
+            reconcile_interval=config.get('fan_reconcile_interval', 900))
+        # the vue worker thread reports back while the driver samples
+        self._fan_lock = threading.Lock()
+        self.dht_stats_interval = config.get('dht_stats_interval', 60)
+        self._dht_stats_at = None
+        self._dht_stats_last = None
+
+    @property
+    def attic_outlet_on(self):
+        # -1 : undefined
+        #  0 : off
+        #  1 : on
+        return -1 if self.fan.state is None else int(self.fan.state)
+
+    def setup(self):
+        backend = self.config.get('backend', 'hardware')
+        if backend == 'hardware':
+            import board
+            import adafruit_dht
+
+            # Initial the dht device, with data pin connected to:
+            self.dhtDevice = adafruit_dht.DHT22(getattr(board, self.config.get('pin', 'D23')))
+        else:
+            import fake_devices
+
+            events = None
+            if backend == 'replay':
+                events = fake_devices.load_recording(self.config['replay'], 'dht')
+            self.dhtDevice = fake_devices.FakeDHT22(events=events)
+        if self.config.get('record'):
+            import fake_devices
+
+            self.dhtDevice = fake_devices.RecordingDHT22(
+                self.dhtDevice, fake_devices.recorder(self.config['record']))
+        self.dht = DhtSampler(self.dhtDevice, window=self.config.get('dht_window', 5))
+        self.dht_time = REGISTRY.histogram(
+            'dht_read_seconds', help='DHT22 read including retries')
+
+        # file clean up
+        try:
+            logging.info('Removing vue token file')
+            os.remove(self.vue_tokenfile)
+        except:
+            logging.warning('Trouble removing vue token file')
+
+        vue_backend = None
+        # simulated sensors switch a simulated outlet unless told otherwise
+        if self.config.get('vue_backend', backend) in ('fake', 'replay'):
+            vue_backend = FakeVueBackend(gids=(self.attic_gid,))
+        self.vue = VueOutletClient(self.vue_username, self.vue_password,
+                                   self.vue_tokenfile, backend=vue_backend)
+        # start from the real outlet state instead of switching blindly
+        self._fan_observed(self.vue.get_outlet_state(self.attic_gid), True)
+        logging.info('attic_outlet_on = ' + str(self.attic_outlet_on))
+
+    def set_attic_fan(self, on):
+        '''
+        queue the outlet update, attic_outlet_on follows once the cloud
+        confirmed it
+        '''
+        logging.info('Turning {} attic fan'.format('on' if on else 'off'))
+        self.vue.set_outlet(self.attic_gid, on, self._fan_switched)
+
+    def _fan_switched(self, on, ok):
+        with self._fan_lock:
+            self.fan.switched(on, ok, time.monotonic())
+
+    def _fan_observed(self, on, ok):
+        with self._fan_lock:
+            if on is not None and self.fan.state is not None and on != self.fan.state:
+                logging.warning('Attic fan was switched {} outside the agent'.format(
+                    'on' if on else 'off'))
+            self.fan.observed(on, time.monotonic())
+
+    def sample(self):
+        cpu_temp = host_telemetry.cpu_temp()
+        # retry until shortly before the next slot
+        ts = time.perf_counter()
+        reading = self.dht.read(time.monotonic() + max(self.interval - 0.5, 0))
+        self.dht_time.observe_since(ts)
+        samples = self._dht_stats()
+        if reading is None:
+            logging.error('No valid DHT reading')
+            return samples
+        temperature_c, humidity = reading
+        temperature_f = temperature_c * (9 / 5) + 32
+        current_time = self.dht.read_time
+
+        now = time.monotonic()
+        with self._fan_lock:
+            if self.fan.reconcile_due(now):
+                self.fan.reconcile_started(now)
+                self.vue.read_outlet(self.attic_gid, self._fan_observed)
+            want = self.fan.update(temperature_c, now)
+            filtered = self.fan.filtered
+
+        logging.info('push to DB, Temp = ' + str(temperature_c) + ' humidity = ' +
+                     str(humidity) + ' cputemp = ' + str(cpu_temp))
+        samples += [
+            Sample("DHT22", {"temp_c": temperature_c,
+                             "temp_f": temperature_f,
+                             "rh": humidity}, current_time),
+            Sample("CPU", {"temp_c": cpu_temp}, current_time),
+            Sample("FAN", {"state": self.attic_outlet_on,
+                           "temp_filtered": filtered}, current_time),
+        ]
+
+        logging.info('attic_outlet_on = ' + str(self.attic_outlet_on))
+        if want is True:
+            logging.warning('Attic is heating up')
+            self.set_attic_fan(True)
+        elif want is False:
+            logging.info('Attic is now cool')
+            self.set_attic_fan(False)
+
+        return samples
+
+    def _dht_stats(self):
+        now = time.monotonic()
+        if self._dht_stats_at is None:
+            self._dht_stats_at = now
+            self._dht_stats_last = self.dht.stats()
+            return []
+        if now - self._dht_stats_at < self.dht_stats_interval:
+            return []
+        stats = self.dht.stats()
+        fields = dict((key, stats[key] - self._dht_stats_last[key])
+                      for key in ('reads', 'failed_reads', 'attempts', 'successes', 'rejected'))
+        fields['success_rate'] = fields['successes'] / max(fields['attempts'], 1)
+        self._dht_stats_at = now
+        self._dht_stats_last = stats
+        return [Sample("DHT22_reads", fields, time.time_ns())]
+
+    def close(self):
+        self.vue.close()
+        self.dhtDevice.exit()
+
+
+class Sen5xDriver(SensorDriver):
+    '''
+    Sensirion SEN5x particulate matter, VOC and NOx sensor on I2C, written
+    to the configured measurement
+
+    config keys: measurement, i2c, period, status_interval, backend,
+    record, replay
+
+    sample() itself waits for the next result through Sen5xScheduler, so
+    the host runs it back to back
+    '''
+
+    name = 'sen5x'
+    default_interval = 0
+
+    def setup(self):
+        from sen5x_scheduler import Sen5xScheduler
+
+        self.measurement = self.config['measurement']
+        backend = self.config.get('backend', 'hardware')
+        self.i2c_transceiver = None
+        if backend == 'hardware':
+            from sensirion_i2c_driver import I2cConnection, LinuxI2cTransceiver
+            from sensirion_i2c_sen5x import Sen5xI2cDevice
+
+            self.i2c_transceiver = LinuxI2cTransceiver(self.config.get('i2c', '/dev/i2c-1'))
+            self.i2c_transceiver.open()
+            device = Sen5xI2cDevice(I2cConnection(self.i2c_transceiver))
+        else:
+            import fake_devices
+
+            events = None
+            if backend == 'replay':
+                events = fake_devices.load_recording(self.config['replay'], 'sen5x')
+            device = fake_devices.FakeSen5x(self.config.get('period', 1.0), events)
+        if self.config.get('record'):
+            import fake_devices
+
+            device = fake_devices.RecordingSen5x(
+                device, fake_devices.recorder(self.config['record']))
+        self.device = device
+
+        # Print some device information
+        logging.info("Version               : {}".format(device.get_version()))
+        logging.info("Product Name          : {}".format(device.get_product_name()))
+        logging.info("Serial Number         : {}".format(device.get_serial_number()))
+        logging.info("Fan cleaning interval : {}".format(device.get_fan_auto_cleaning_interval()))
+        # Perform a device reset (reboot firmware)
+        device.device_reset()
+
+        # Start measurement
+        device.start_measurement()
+        self.scheduler = Sen5xScheduler(
+            device, period=self.config.get('period', 1.0),
+            status_interval=self.config.get('status_interval', 60))
+        self.i2c_time = REGISTRY.histogram(
+            'i2c_wait_seconds', {'driver': self.name},
+            help='time waiting on I2C sensor results')
+
+    def sample(self):
+        device = self.device
+        # Wait until next result is available
+        logging.debug("Waiting for new data...")
+        if not self.scheduler.wait_ready():
+            logging.warning('No SEN5x result within {}s'.format(self.scheduler.timeout))
+            return []
+
+        current_time = time.time_ns()
+        # Read measured values -> clears the "data ready" flag
+        ts = time.perf_counter()
+        values = device.read_measured_values()
+        self.i2c_time.observe_since(ts)
+        fields = {}
+
+        if (values.mass_concentration_1p0.available):
+            if (values.mass_concentration_1p0.physical != 0.0):
+                fields["mc1p0"] = values.mass_concentration_1p0.physical
+            if (values.mass_concentration_2p5.physical != 0.0):
+                fields['mc2p5'] = values.mass_concentration_2p5.physical
+            if (values.mass_concentration_4p0.physical != 0.0):
+                fields['mc4p0'] = values.mass_concentration_4p0.physical
+            if (values.mass_concentration_10p0.physical != 0.0):
+                fields['mc10p0'] = values.mass_concentration_10p0.physical
+
+        if (values.ambient_humidity.available):
+            fields['rh'] = values.ambient_humidity.percent_rh
+
+        if (values.ambient_temperature.available):
+            fields['temp_c'] = values.ambient_temperature.degrees_celsius
+            fields['temp_f'] = values.ambient_temperature.degrees_fahrenheit
+
+        if (values.voc_index.available):
+            fields['voc_index'] = values.voc_index.scaled
+
+        if (values.nox_index.available):
+            fields['nox_index'] = values.nox_index.scaled
+
+        logging.debug('values: \n{}'.format(values))
+
+        # Read device status
+        if self.scheduler.status_due():
+            status = device.read_device_status()
+            logging.info("Device Status: {}".format(status))
+            logging.info("Scheduler: {}".format(self.scheduler.stats()))
+
+        if not fields:
+            return []
+        logging.info('push to influxDB2')
+        return [Sample(self.measurement, fields, current_time)]
+
+    def close(self):
+        # Stop measurement
+        self.device.stop_measurement()
+        if self.i2c_transceiver is not None:
+            self.i2c_transceiver.close()
+        logging.info("Measurement stopped.")
+
+
+class HostDriver(SensorDriver):
+    '''
+    health of the Pi itself (host_telemetry.py): thermal zones, cpu load
+    and frequency, memory, SD card I/O and throttling, as one point of the
+    configured measurement
+
+    config keys: interval, measurement, disk
+    '''
+
+    name = 'host'
+    default_interval = 60
+
+    def setup(self):
+        self.measurement = self.config.get('measurement', 'host_telemetry')
+        self.telemetry = host_telemetry.telemetry(self.config.get('disk'))
+        # rates and busy shares are measured from here on
+        self.telemetry.read()
+
+    def sample(self):
+        current_time = time.time_ns()
+        fields = self.telemetry.read()
+        if not fields:
+            return []
+        return [Sample(self.measurement, fields, current_time)]
+
+
+DRIVERS = {
+    PoolDriver.name: PoolDriver,
+    AtticDriver.name: AtticDriver,
+    Sen5xDriver.name: Sen5xDriver,
+    HostDriver.name: HostDriver,
+}
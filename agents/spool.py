@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+import logging
+import os
+import sys
+import time
+
+
+class Spool:
+    '''
+    append only on-disk spool of line protocol records
+
+    records are appended to numbered segment files, fsync'ed in batches
+    (every fsync_bytes or fsync_interval seconds) and the segment is rotated
+    once it reaches segment_bytes. when the whole spool grows past max_bytes
+    the oldest segments are deleted, so a long outage costs old data instead
+    of filling the SD card. replay() hands the records back oldest first
+
+    the tail segment stays open for appending while the spool is replayed;
+    a failed replay resumes after the last records that were sent
+    '''
+
+    PREFIX = 'segment-'
+    SUFFIX = '.lp'
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024,
+                 max_bytes=256 * 1024 * 1024, fsync_bytes=64 * 1024,
+                 fsync_interval=5.0):
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._fsync_bytes = fsync_bytes
+        self._fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(self._list_segments())
+        self._sizes = {}
+        for seq in self._segments:
+            self._sizes[seq] = os.path.getsize(self._path(seq))
+        self._total = sum(self._sizes.values())
+        # bytes of the oldest segment already replayed
+        self._sent = 0
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        if self._segments:
+            logging.info('Spool {} holds {} bytes in {} segments'.format(
+                directory, self.pending_bytes, len(self._segments)))
+
+    @property
+    def pending_bytes(self):
+        return self._total - self._sent
+
+    def append(self, lines):
+        '''
+        append a list of line protocol records as bytes
+        '''
+        if lines:
+            self.append_bytes(b'\n'.join(lines) + b'\n')
+
+    def append_bytes(self, data):
+        '''
+        append line protocol records that each end with a newline
+        '''
+        if not data:
+            return
+        if self._file is None or self._sizes[self._segments[-1]] >= self._segment_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._sizes[self._segments[-1]] += len(data)
+        self._total += len(data)
+        self._unsynced += len(data)
+        if (self._unsynced >= self._fsync_bytes or
+                time.monotonic() - self._last_sync >= self._fsync_interval):
+            self.sync()
+        self._evict()
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def replay(self, send, batch_bytes=1024 * 1024):
+        '''
+        call send(list_of_lines) with the spooled records as bytes, oldest
+        first, in batches of about batch_bytes. a segment is deleted once all
+        of it was sent and the open tail segment is emptied instead; if send
+        raises, replay stops and the next one starts with the failed batch
+
+        returns (records, bytes, seconds) for the records that were sent
+        '''
+        records = 0
+        sent_bytes = 0
+        ts = time.monotonic()
+        while self._segments:
+            seq = self._segments[0]
+            tail = self._file is not None and seq == self._segments[-1]
+            if tail:
+                # the records appended so far, the file stays open
+                self._file.flush()
+            with open(self._path(seq), 'rb') as f:
+                f.seek(self._sent)
+                while True:
+                    chunk = f.readlines(batch_bytes)
+                    if not chunk:
+                        break
+                    lines = [line.rstrip(b'\n') for line in chunk]
+                    send(lines)
+                    size = sum(len(line) for line in chunk)
+                    self._sent += size
+                    records += len(lines)
+                    sent_bytes += size
+            if tail:
+                self._truncate_tail()
+                break
+            self._remove(seq)
+        seconds = time.monotonic() - ts
+        if records:
+            logging.info('Spool replayed {} records ({} bytes) in {:.2f}s, '
+                         '{:.0f} records/s'.format(records, sent_bytes, seconds,
+                                                    records / max(seconds, 1e-9)))
+        return records, sent_bytes, seconds
+
+    def close(self):
+        self._close_segment()
+
+    def _list_segments(self):
+        for name in os.listdir(self._directory):
+            if name.startswith(self.PREFIX) and name.endswith(self.SUFFIX):
+                try:
+                    yield int(name[len(self.PREFIX):-len(self.SUFFIX)])
+                except ValueError:
+                    pass
+
+    def _path(self, seq):
+        return os.path.join(self._directory, '{}{:012d}{}'.format(
+            self.PREFIX, seq, self.SUFFIX))
+
+    def _rotate(self):
+        self._close_segment()
+        seq = self._segments[-1] + 1 if self._segments else 0
+        self._file = open(self._path(seq), 'ab')
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+
+    def _close_segment(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _evict(self):
+        while len(self._segments) > 1 and self.pending_bytes > self._max_bytes:
+            seq = self._segments[0]
+            logging.warning('Spool full, dropping {} bytes from segment {}'.format(
+                self._sizes[seq], seq))
+            self._remove(seq)
+
+    def _truncate_tail(self):
+        # everything in the open tail was sent, start it over empty
+        seq = self._segments[-1]
+        os.ftruncate(self._file.fileno(), 0)
+        self._total -= self._sizes[seq]
+        self._sizes[seq] = 0
+        self._sent = 0
+        self._unsynced = 0
+
+    def _remove(self, seq):
+        os.remove(self._path(seq))
+        if seq == self._segments[0]:
+            self._sent = 0
+        self._segments.remove(seq)
+        self._total -= self._sizes.pop(seq)
+
+
+def bench(records=200000):
+    '''
+    fill a scratch spool with synthetic pool points and time the append
+    and replay paths
+    '''
+    import tempfile
+    line = b'pool ORP=650.2,temp_c=27.5,temp_f=81.5,pH=7.42,Water\\ Level=3.91 %d'
+    with tempfile.TemporaryDirectory() as directory:
+        spool = Spool(directory)
+        ts = time.monotonic()
+        for i in range(0, records, 100):
+            spool.append([line % (1700000000000000000 + j) for j in range(i, i + 100)])
+        spool.sync()
+        ta = time.monotonic() - ts
+        print('append: {} records in {:.2f}s, {:.0f} records/s'.format(
+            records, ta, records / ta))
+        n, nbytes, seconds = spool.replay(lambda lines: None)
+        print('replay: {} records, {:.1f} MB in {:.2f}s, {:.0f} records/s, {:.1f} MB/s'.format(
+            n, nbytes / 1e6, seconds, n / seconds, nbytes / 1e6 / seconds))
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
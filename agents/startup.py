@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+import json
+import os
+import sys
+import time
+
+from metrics import REGISTRY
+
+# the stages of a cold start, in the order they normally complete
+STAGES = ('imports', 'drivers_ready', 'first_sample', 'writer_ready', 'first_write')
+
+
+def _process_start():
+    '''
+    time.perf_counter() value when this process was started, so the marks
+    include the interpreter start up and the imports of the launcher
+    '''
+    try:
+        with open('/proc/self/stat', 'rb') as f:
+            stat = f.read()
+        with open('/proc/uptime', 'rb') as f:
+            uptime = float(f.read().split()[0])
+        # starttime, field 22, in clock ticks after boot; the command name
+        # before it is in parentheses and may hold spaces
+        started = int(stat[stat.rindex(b')') + 2:].split()[19])
+        return time.perf_counter() - (uptime - started / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter()
+
+
+STARTED = _process_start()
+# stage: seconds from the process start
+MARKS = {}
+
+
+def mark(stage):
+    '''
+    record the first time stage is reached, as seconds since the process
+    started and as the startup_seconds gauge
+    '''
+    if stage not in MARKS:
+        MARKS[stage] = seconds = time.perf_counter() - STARTED
+        REGISTRY.gauge('startup_seconds', {'stage': stage},
+                       help='process start to startup stage').set(seconds)
+
+
+def summary():
+    return ', '.join('{} {:.2f}s'.format(stage, MARKS[stage])
+                     for stage in STAGES if stage in MARKS)
+
+
+def _import_profile(stderr):
+    '''
+    {package: cumulative seconds} from the -X importtime output, counting
+    only top level package names so the report says what costs what
+    '''
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            cumulative = int(cumulative) / 1e6
+        except ValueError:
+            # the header line
+            continue
+        name = name.strip()
+        if '.' not in name:
+            packages[name] = max(packages.get(name, 0), cumulative)
+    return packages
+
+
+def bench(command, runs=3, budget=None, top=15, timeout=300):
+    '''
+    start the agent command runs times in fresh processes under
+    -X importtime, each stops itself after its first successful write and
+    reports its startup marks (see AGENT_STARTUP_REPORT in agent_host.py),
+    print the marks, their medians and the slowest imports
+
+    returns False when a run failed or the median process start to first
+    write is over budget seconds
+    '''
+    import statistics
+    import subprocess
+    import tempfile
+
+    results = []
+    profiles = []
+    with tempfile.TemporaryDirectory() as directory:
+        for run in range(runs):
+            report = os.path.join(directory, 'startup-{}.json'.format(run))
+            env = dict(os.environ, AGENT_STARTUP_REPORT=report)
+            ts = time.perf_counter()
+            try:
+                process = subprocess.run(
+                    [sys.executable, '-X', 'importtime'] + command, env=env,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                    universal_newlines=True, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                print('run {}: no write within {}s'.format(run + 1, timeout))
+                return False
+            elapsed = time.perf_counter() - ts
+            if not os.path.exists(report):
+                print('run {}: exited with {} before its first write'.format(
+                    run + 1, process.returncode))
+                print('\n'.join(line for line in process.stderr.splitlines()
+                                if not line.startswith('import time:'))[-2000:])
+                return False
+            with open(report) as f:
+                marks = json.load(f)
+            results.append(marks)
+            profiles.append(_import_profile(process.stderr))
+            print('run {}: {} (process {:.2f}s)'.format(run + 1, ', '.join(
+                '{} {:.2f}s'.format(stage, marks[stage])
+                for stage in STAGES if stage in marks), elapsed))
+
+    print('\nmedian of {} runs'.format(runs))
+    for stage in STAGES:
+        values = [marks[stage] for marks in results if stage in marks]
+        if values:
+            print('  {:14} {:6.2f}s'.format(stage, statistics.median(values)))
+
+    print('\nslowest imports (median cumulative)')
+    names = set().union(*profiles)
+    costs = {name: statistics.median(profile.get(name, 0) for profile in profiles)
+             for name in names}
+    for name in sorted(costs, key=costs.get, reverse=True)[:top]:
+        print('  {:30} {:6.3f}s'.format(name, costs[name]))
+
+    first_write = statistics.median(marks['first_write'] for marks in results)
+    if budget is not None and first_write > budget:
+        print('\nfirst write after {:.2f}s, over the {:.2f}s budget'.format(
+            first_write, budget))
+        return False
+    return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='cold start of an agent to its first written sample')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--budget', type=float,
+                        help='fail when the median first write takes longer, seconds')
+    parser.add_argument('--top', type=int, default=15,
+                        help='number of imports to list')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='agent script and its arguments, e.g. agent-pool.py /tmp/pool.log')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error('no agent command')
+    ok = bench(args.command, args.runs, args.budget, args.top, args.timeout)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+import binascii
+import collections
+import itertools
+import logging
+import struct
+import threading
+import time
+
+from metrics import REGISTRY
+
+# summary of the readings received since the previous aggregate() call
+WindowStats = collections.namedtuple(
+    "WindowStats", ["count", "mean", "min", "max", "median", "latest"])
+
+
+class FrameDecoder:
+    '''
+    decodes the binary frames of read_analog.ino (BINARY_FRAMES 1)
+
+        0xA5 0x5A | seq u16 | count u8 | count x sample u16 | crc u16
+
+    all little endian, crc is CRC-16/CCITT-FALSE over seq, count and the
+    samples. feed() takes raw bytes in any split and returns the sample
+    blocks of the complete frames, counting gaps in seq as dropped frames.
+    a seq that goes backwards (the Teensy rebooted) is a resync, not
+    65000 lost frames
+    '''
+
+    SYNC = b'\xa5\x5a'
+    HEADER = struct.Struct('<HB')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._next_seq = None
+        self.frames = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.crc_errors = 0
+
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        blocks = []
+        pos = 0
+        while True:
+            start = buf.find(self.SYNC, pos)
+            if start < 0:
+                # keep a trailing byte that may be the first half of a sync
+                pos = max(len(buf) - 1, pos)
+                break
+            if len(buf) < start + 5:
+                pos = start
+                break
+            seq, count = self.HEADER.unpack_from(buf, start + 2)
+            end = start + 5 + 2 * count
+            if len(buf) < end + 2:
+                pos = start
+                break
+            crc = buf[end] | buf[end + 1] << 8
+            if binascii.crc_hqx(buf[start + 2:end], 0xFFFF) != crc:
+                self.crc_errors += 1
+                pos = start + 1
+                continue
+            if self._next_seq is not None:
+                gap = (seq - self._next_seq) & 0xFFFF
+                if gap >= 0x8000:
+                    self.resyncs += 1
+                else:
+                    self.dropped += gap
+            self._next_seq = (seq + 1) & 0xFFFF
+            self.frames += 1
+            blocks.append(struct.unpack_from('<{}H'.format(count), buf, start + 5))
+            pos = end + 2
+        del buf[:pos]
+        return blocks
+
+
+class SerialSampler:
+    '''
+    drains the Teensy serial stream on a background thread
+
+    everything the port has buffered is read in one call, split into lines
+    and parsed, so the OS buffer never fills with stale readings. the
+    newest value is kept in latest and every value goes into a window that
+    aggregate() summarizes and empties once per poll interval. the reader
+    thread only appends to a deque and rebinds latest, so neither side
+    needs a lock
+
+    with binary=True the stream is decoded as FrameDecoder frames and the
+    window receives whole sample blocks
+
+    when reads fail (the Teensy reset or its USB cable came loose) the
+    thread waits with a backoff that doubles from backoff_start up to
+    backoff_max, logs at most once per log_interval seconds and closes and
+    reopens the port after every reopen_after failures in a row
+    '''
+
+    def __init__(self, ser, parse=float, max_window=10000, binary=False,
+                 backoff_start=0.1, backoff_max=10.0, reopen_after=3,
+                 log_interval=60.0):
+        self._ser = ser
+        self._parse = parse
+        self._decoder = FrameDecoder() if binary else None
+        # blocks of values, one value per block for the ASCII stream
+        self._window = collections.deque(maxlen=max_window)
+        self._running = False
+        self._thread = None
+        self._stopped = threading.Event()
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.reopen_after = reopen_after
+        self.log_interval = log_interval
+        self.latest = None
+        self.errors = 0
+        self._wait_time = REGISTRY.histogram(
+            'serial_wait_seconds', help='time blocked in one serial read')
+        self._bytes = REGISTRY.counter('serial_bytes_total')
+        self._frames_dropped = REGISTRY.counter('serial_frames_dropped_total')
+        self._resyncs = REGISTRY.counter(
+            'serial_resyncs_total', help='frame seq restarts, the Teensy rebooted')
+        self._read_errors = REGISTRY.counter('serial_read_errors_total')
+
+    def start(self):
+        self._running = True
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='serial-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(2 * (self._ser.timeout or 1))
+
+    def aggregate(self):
+        '''
+        WindowStats over the values received since the last call, None if
+        nothing arrived
+        '''
+        window = self._window
+        blocks = [window.popleft() for i in range(len(window))]
+        values = list(itertools.chain.from_iterable(blocks))
+        if not values:
+            return None
+        values.sort()
+        n = len(values)
+        if n % 2:
+            median = values[n // 2]
+        else:
+            median = (values[n // 2 - 1] + values[n // 2]) / 2
+        return WindowStats(n, sum(values) / n, values[0], values[-1],
+                           median, self.latest)
+
+    def _run(self):
+        pending = b''
+        failures = 0
+        backoff = self.backoff_start
+        logged_at = None
+        while self._running:
+            ts = time.perf_counter()
+            try:
+                # blocks up to the port timeout for the first byte, then
+                # takes whatever else is already buffered
+                data = self._ser.read(max(self._ser.in_waiting, 1))
+            except Exception as error:
+                failures += 1
+                self.errors += 1
+                self._read_errors.inc()
+                now = time.monotonic()
+                if logged_at is None or now - logged_at >= self.log_interval:
+                    logged_at = now
+                    logging.error('Serial read failed ({} in a row): {}'.format(
+                        failures, error))
+                if failures % self.reopen_after == 0:
+                    # a partial line or frame from before the failure is stale
+                    pending = b''
+                    self._reopen()
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+            if failures:
+                logging.info('Serial port back after {} failed reads'.format(failures))
+                failures = 0
+                backoff = self.backoff_start
+                logged_at = None
+            self._wait_time.observe_since(ts)
+            if not data:
+                continue
+            self._bytes.inc(len(data))
+            if self._decoder is not None:
+                dropped = self._decoder.dropped
+                resyncs = self._decoder.resyncs
+                for block in self._decoder.feed(data):
+                    if block:
+                        self._window.append(block)
+                        self.latest = block[-1]
+                if self._decoder.dropped != dropped:
+                    self._frames_dropped.inc(self._decoder.dropped - dropped)
+                    logging.warning('Teensy dropped {} frames, {} CRC errors so far'.format(
+                        self._decoder.dropped, self._decoder.crc_errors))
+                if self._decoder.resyncs != resyncs:
+                    self._resyncs.inc(self._decoder.resyncs - resyncs)
+                    logging.info('Teensy frame seq went back, resynced')
+                continue
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                self._add(line)
+
+    def _reopen(self):
+        try:
+            self._ser.close()
+            self._ser.open()
+        except Exception as error:
+            # the device is still gone, try again after the next failures
+            logging.debug('Serial reopen failed: {}'.format(error))
+
+    def _add(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            value = self._parse(line)
+        except ValueError:
+            self.errors += 1
+            return
+        self.latest = value
+        self._window.append((value,))
@@ -1,7 +1,22 @@
+// Set to 1 to send oversampled readings in binary frames instead of one
+// ASCII line every 100 ms. Frame layout, little endian:
+//   0xA5 0x5A | seq (uint16) | count (uint8) | count x sample (uint16) | crc (uint16)
+// crc is CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over seq, count and samples
+#define BINARY_FRAMES 0
+
+#define SAMPLE_US 10000      // one sample every 10 ms in binary mode
+#define FRAME_SAMPLES 50     // samples per frame, one frame every 500 ms
+#define ADC_AVERAGING 16     // hardware averaging per sample
+
 void setup() {
   // put your setup code here, to run once:
 
+#if BINARY_FRAMES
+  Serial.begin(115200);
+  analogReadAveraging(ADC_AVERAGING);
+#else
   Serial.begin(9600);
+#endif
   while (!Serial) {
     ; // wait for serial port to connect. Needed for native USB port only
   }
@@ -9,9 +24,56 @@ void setup() {
 
 int val;
 
+#if BINARY_FRAMES
+
+uint8_t frame[5 + 2 * FRAME_SAMPLES + 2];
+uint16_t seq = 0;
+uint8_t count = 0;
+elapsedMicros since_sample;
+
+uint16_t crc16(const uint8_t *data, int len) {
+  uint16_t crc = 0xFFFF;
+  for (int i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int b = 0; b < 8; b++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void loop() {
+  if (since_sample < SAMPLE_US) {
+    return;
+  }
+  since_sample -= SAMPLE_US;
+  val = analogRead(9);
+  frame[5 + 2 * count] = val & 0xFF;
+  frame[6 + 2 * count] = val >> 8;
+  count++;
+  if (count == FRAME_SAMPLES) {
+    int len = 5 + 2 * count;
+    frame[0] = 0xA5;
+    frame[1] = 0x5A;
+    frame[2] = seq & 0xFF;
+    frame[3] = seq >> 8;
+    frame[4] = count;
+    uint16_t crc = crc16(frame + 2, len - 2);
+    frame[len] = crc & 0xFF;
+    frame[len + 1] = crc >> 8;
+    Serial.write(frame, len + 2);
+    seq++;
+    count = 0;
+  }
+}
+
+#else
+
 void loop() {
   // put your main code here, to run repeatedly:
   val = analogRead(9);
   Serial.println(val);
   delay(100);
 }
+
+#endif
@@ -1,25 +1,43 @@
-from influxdb import InfluxDBClient as InfluxDBClient15
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
 import sys
+import os
+import re
 import json
+import argparse
+import calendar
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(
+    description='migrate InfluxDB 1.x measurements to InfluxDB 2.x')
+parser.add_argument('json_filename', help='auth and migration jobs')
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--verify', action='store_true',
+                  help='compare every window of source and destination, write nothing')
+mode.add_argument('--repair', action='store_true',
+                  help='verify, then migrate again only the windows that differ')
+args = parser.parse_args()
+json_filename = args.json_filename
+with open(json_filename, 'r') as f:
+    input_dict = json.load(f)
+
+# the clients, rich and numpy take seconds to import on a Pi, only pay for
+# them once there is a job to run
+from influxdb import InfluxDBClient as InfluxDBClient15
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
 import coloredlogs
 import rich
 import rich.progress
-import signal
-import time
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 coloredlogs.install(level='INFO')
-
-if len(sys.argv) > 1:
-    json_filename = sys.argv[1]
-    logging.info('json file is {}'.format(json_filename))
-    with open(json_filename, 'r') as f:
-        input_dict = json.load(f)
-else:
-    logging.error("must have a json argument to tell the script what to do")
-    sys.exit()
+logging.info('json file is {}'.format(json_filename))
 
 
 db15_host = input_dict["auth"]["db15_host"]
@@ -35,91 +53,668 @@ db2_bucket = input_dict["auth"]["db2_bucket"]
 logging.info("Migration authentication:\n{}".format(
     json.dumps(input_dict["auth"], indent=4)))
 
+# defaults for the optional job keys
+DEFAULT_WINDOW = 7 * 24 * 3600   # seconds of source data per time window
+DEFAULT_WORKERS = 4              # windows queried in parallel
+DEFAULT_WRITERS = 2              # parallel writes to InfluxDB 2.x
+QUEUE_DEPTH = 16                 # batches buffered between readers and writers
+WRITE_RETRIES = 3
+DEFAULT_VERIFY_BLOCK = 16        # windows compared by one verification query
+VERIFY_TOLERANCE = 1e-6          # relative difference allowed between aggregates
+
+
+def escape_measurement(name):
+    return name.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(key):
+    return key.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _format_number(value):
+    # booleans and strings keep their type, numbers are written as declared
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, str):
+        return format_value(value).encode()
+    return repr(float(value)).encode()
+
+
+def _format_int(value):
+    if isinstance(value, (bool, str)):
+        return _format_number(value)
+    return b'%di' % round(value)
+
+
+def _format_any(value):
+    return format_value(value).encode()
+
+
+# how the values of a db2 field are written. 1.x returns whole floats as
+# JSON integers, so by default a field is written as the type SHOW FIELD
+# KEYS reports for it, "auto" (the type of the returned value) only for
+# booleans and strings; the "types" of a job override it
+FIELD_FORMATS = {
+    'float': _format_number,
+    'int': _format_int,
+    'auto': _format_any,
+}
+
+
+class Checkpoint:
+    '''
+    completed time windows of one migration job
+
+    everything before watermark has been written and acknowledged, windows
+    finished out of order are kept in done (window start -> points written)
+    until the watermark catches up with them. the file is rewritten
+    atomically after every completed window
+    '''
+
+    def __init__(self, path, window):
+        self.path = path
+        self.window = window
+        self.watermark = None
+        self.done = {}
+        self.acknowledged = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            self.watermark = saved["watermark"]
+            self.acknowledged = saved["acknowledged"]
+            if saved["window"] == window:
+                self.done = {int(a): n for a, n in saved["done"].items()}
+            else:
+                # windows no longer line up, restart them from the watermark
+                logging.warning("window size changed, resuming from the watermark")
+            logging.info("Resuming from checkpoint {}: {} points acknowledged".format(
+                path, self.acknowledged))
+
+    def origin(self, first):
+        '''
+        start of the first window, aligned so windows match the checkpoint
+        '''
+        if self.watermark is None:
+            self.watermark = first - first % self.window
+        return self.watermark
+
+    def is_done(self, a):
+        return a < self.watermark or a in self.done
+
+    def mark_done(self, a, points):
+        with self._lock:
+            self.done[a] = points
+            self.acknowledged += points
+            while self.watermark in self.done:
+                del self.done[self.watermark]
+                self.watermark += self.window
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"window": self.window, "watermark": self.watermark,
+                       "acknowledged": self.acknowledged,
+                       "done": {str(a): n for a, n in self.done.items()}}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def checkpoint_path(job):
+    if "checkpoint" in job:
+        return job["checkpoint"]
+    fields = job["db15_field"] if "db15_field" in job else '+'.join(sorted(job["fields"]))
+    slug = '.'.join(re.sub(r'[^A-Za-z0-9_+-]+', '_', name)
+                    for name in (job["db15_meas"], fields))
+    return '{}.{}.checkpoint'.format(os.path.splitext(json_filename)[0], slug)
+
+
+def flux_string(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def to_ns(moment):
+    # the datetimes of the 2.x query results, UTC with microseconds
+    return calendar.timegm(moment.utctimetuple()) * 10**9 + moment.microsecond * 1000
+
 
-for p2migrate in input_dict["migration"]:
-    logging.info("Migrating:\n{}".format(json.dumps(p2migrate, indent=4)))
+def close_enough(a, b):
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= VERIFY_TOLERANCE * max(abs(a), abs(b), 1e-9)
 
-    # Connect to InfluxDB 1.5
+
+def format_window(a):
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(a // 10**9))
+
+
+def derive(column, scale, offset):
+    '''
+    scale * column + offset over a whole column, None stays None
+    '''
+    if np is None:
+        return [None if v is None else v * scale + offset for v in column]
+    values = (np.array(column, dtype=float) * scale + offset).tolist()
+    return [v if v == v else None for v in values]
+
+
+def connect15():
     client15 = InfluxDBClient15(
         host=db15_host, port=db15_port, username=db15_un, password=db15_pw)
     client15.switch_database(db15_db)
+    return client15
+
+
+class WindowMigrator:
+    '''
+    migrates one job, either a single (db15_meas, db15_field) ->
+    (db2_meas, db2_field) pair or a whole measurement at once:
+
+        "fields":  {"<db15 field>": "<db2 field>", ...}
+        "tags":    {"<db15 tag>": "<db2 tag>", ...}
+        "derived": {"<db2 field>": {"from": "<db2 field>", "scale": s, "offset": o}}
+        "types":   {"<db2 field>": "float" | "int" | "auto"}
+
+    every field of a timestamp goes out in one line. a field is written as
+    "float" or "int" after its 1.x type from SHOW FIELD KEYS ("float" when
+    shards disagree), derived fields of numbers as "float", anything else
+    keeps the type 1.x returned ("auto"); "types" overrides any of them
+
+    the source time range is cut into windows (WHERE time >= a AND time < b),
+    a pool of reader threads streams several windows at once with chunked
+    responses and turns the rows straight into line protocol, writer threads
+    send the batches to InfluxDB 2.x through a bounded queue so queries and
+    writes overlap
+
+    verify() compares count, sum, min and max of every field per window
+    between source and destination, verify_block windows per query, and
+    repair() migrates again only the windows where they differ
+    '''
+
+    def __init__(self, job):
+        self.meas15 = job["db15_meas"]
+        self.meas2 = job["db2_meas"]
+        if "fields" in job:
+            self.fields = job["fields"]
+            self.derived = job.get("derived", {})
+        else:
+            self.fields = {job["db15_field"]: job["db2_field"]}
+            # the rule single field jobs have always applied
+            self.derived = {}
+            if job["db2_field"] == 'temp_c':
+                self.derived = {'temp_f': {'from': 'temp_c', 'scale': 1.8, 'offset': 32}}
+        self.tags = job.get("tags", {})
+        self.types = job.get("types", {})
+        for dst, kind in self.types.items():
+            if kind not in FIELD_FORMATS:
+                raise ValueError('unknown type {!r} of field {}'.format(kind, dst))
+        # FIELD_FORMATS key of every db2 field, set by resolve_types()
+        self._formats = dict(self.types)
+        self._select = ','.join('"{}"'.format(name)
+                                for name in list(self.fields) + list(self.tags))
+        self.chunk_size = job["chunk"]
+        self.window = int(job.get("window", DEFAULT_WINDOW) * 1e9)
+        self.workers = job.get("workers", DEFAULT_WORKERS)
+        self.writers = job.get("writers", DEFAULT_WRITERS)
+        self.verify_block = job.get("verify_block", DEFAULT_VERIFY_BLOCK)
+        if job.get("offset"):
+            logging.warning("offset is ignored, windows are resumed by time")
+        self._measurement = escape_measurement(self.meas2).encode()
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._stop = threading.Event()
+        self._failed = []
+        self._checkpoint = Checkpoint(checkpoint_path(job), self.window)
+        # repaired windows are not checkpointed, they were done before
+        self._checkpointing = True
+        # per window: batches not yet acknowledged, points written, reader done
+        self._progress_lock = threading.Lock()
+        self._outstanding = {}
+        self._written = {}
+        self._finished = set()
+
+    def _client15(self):
+        # the 1.x client wraps a requests session, give each reader its own
+        if not hasattr(self._local, 'client15'):
+            self._local.client15 = connect15()
+        return self._local.client15
+
+    def count_points(self):
+        '''
+        number of lines to write, the count of the most populated field
+        '''
+        counts = ','.join('COUNT("{}")'.format(name) for name in self.fields)
+        count_query = f'SELECT {counts} FROM "{self.meas15}"'
+        count_result = self._client15().query(count_query)
+        total_points = 0
+        for point_count in count_result.get_points():
+            for key, value in point_count.items():
+                if key.lower() != 'time':
+                    total_points = max(total_points, value)
+        return total_points
+
+    def time_range(self):
+        '''
+        return [first, last] in ns of the source field, or None when empty
+        '''
+        bounds = []
+        for order in ('ASC', 'DESC'):
+            query = (f'SELECT {self._select} FROM "{self.meas15}" '
+                     f'ORDER BY time {order} LIMIT 1')
+            points = list(self._client15().query(query, epoch='ns').get_points())
+            if not points:
+                return None
+            bounds.append(points[0]['time'])
+        return bounds
+
+    def source_field_types(self):
+        '''
+        {db15 field: set of 1.x types}, a field can have a different type
+        in each shard
+        '''
+        result = self._client15().query(f'SHOW FIELD KEYS FROM "{self.meas15}"')
+        types = {}
+        for point in result.get_points():
+            types.setdefault(point['fieldKey'], set()).add(point['fieldType'])
+        return types
+
+    def resolve_types(self):
+        '''
+        pick the FIELD_FORMATS key of every db2 field from the 1.x field
+        types, the "types" of the job win
+        '''
+        source = self.source_field_types()
+        formats = {}
+        for src, dst in self.fields.items():
+            kinds = source.get(src, set())
+            if 'float' in kinds:
+                formats[dst] = 'float'
+            elif 'integer' in kinds:
+                formats[dst] = 'int'
+            else:
+                formats[dst] = 'auto'
+        for dst, rule in self.derived.items():
+            numeric = formats.get(rule['from']) in ('float', 'int')
+            formats[dst] = 'float' if numeric else 'auto'
+        formats.update(self.types)
+        self._formats = formats
+        logging.info("Field types: {}".format(', '.join(
+            '{} {}'.format(dst, kind) for dst, kind in sorted(formats.items()))))
+
+    def windows(self, first, last):
+        '''
+        windows between first and last that the checkpoint has not seen done
+        '''
+        start = self._checkpoint.origin(first)
+        return [(a, a + self.window) for a in range(start, last + 1, self.window)
+                if not self._checkpoint.is_done(a)]
+
+    def to_lines(self, columns, values, buf):
+        '''
+        append a block of rows to the bytearray buf as one line per
+        timestamp and return the number of lines. the rows are transposed
+        into columns first so derived fields are computed on whole columns,
+        keys are escaped once per block and no Point is built per row
+        '''
+        if not values:
+            return 0
+        data = dict(zip(columns, zip(*values)))
+        fields = {}
+        for src, dst in self.fields.items():
+            if src in data:
+                fields[dst] = data[src]
+        for dst, rule in self.derived.items():
+            if rule['from'] in fields:
+                fields[dst] = derive(fields[rule['from']], rule['scale'], rule['offset'])
+        fields = [((' ' + escape_key(dst) + '=').encode(),
+                   (',' + escape_key(dst) + '=').encode(),
+                   FIELD_FORMATS[self._formats.get(dst, 'auto')], column)
+                  for dst, column in fields.items()]
+        tags = [((',' + escape_key(dst) + '=').encode(), data[src])
+                for src, dst in sorted(self.tags.items(), key=lambda t: t[1])
+                if src in data]
 
-    # Query the total number of points in the measurement
-    meas15 = p2migrate["db15_meas"]
-    field15 = p2migrate["db15_field"]
-    meas2 = p2migrate["db2_meas"]
-    field2 = p2migrate["db2_field"]
-
-    count_query = f'SELECT COUNT(*) FROM "{meas15}"'
-    count_result = client15.query(count_query)
-
-    # Extract the total number of points from the result
-    total_points = 0
-    for point_count in count_result.get_points():
-        for key, value in point_count.items():
-            if key.lower() != 'time':
-                total_points += value
-
-    logging.info("Measurement {} has {} points".format(meas15, total_points))
-
-    # Connect to InfluxDB 2.6
-    client2 = InfluxDBClient(url=db2_url, token=db2_token, org=db2_org)
-    write_api = client2.write_api(write_options=SYNCHRONOUS)
-
-    # Query and transfer data in chunks of 1000 points
-    chunk_size = p2migrate["chunk"]
-    offset = p2migrate["offset"]
-    logging.info("Starting to migrate from offset {}".format(offset))
-
-    try:
-        with rich.progress.Progress() as progress:
-            task = progress.add_task("[cyan]Migrating ({},{}) -> ({},{})...".format(
-                meas15, field15, meas2, field2), total=total_points)
-            progress.update(task, advance=offset)
-
-            while True:
-                # Query data from InfluxDB 1.5
-                query = f'SELECT * FROM "{meas15}" LIMIT {chunk_size} OFFSET {offset}'
-                ts = time.monotonic()
-                result_set = client15.query(query)
-                te = time.monotonic()
-                tq = round(te - ts, 2)
-
-                if not result_set:
+        count = 0
+        for i, ts in enumerate(data['time']):
+            start = len(buf)
+            buf += self._measurement
+            for key, column in tags:
+                if column[i] is not None:
+                    buf += key
+                    buf += escape_key(str(column[i])).encode()
+            first = True
+            for space_key, comma_key, fmt, column in fields:
+                value = column[i]
+                if value is None:
+                    continue
+                buf += space_key if first else comma_key
+                buf += fmt(value)
+                first = False
+            if first:
+                del buf[start:]
+                continue
+            buf += b' %d\n' % ts
+            count += 1
+        return count
+
+    def read_window(self, window):
+        if self._stop.is_set():
+            return
+        a, b = window
+        query = (f'SELECT {self._select} FROM "{self.meas15}" '
+                 f'WHERE time >= {a} AND time < {b}')
+        buf = bytearray()
+        count = 0
+        for result_set in self._client15().query(
+                query, epoch='ns', chunked=True, chunk_size=self.chunk_size):
+            if self._stop.is_set():
+                return
+            for series in result_set.raw.get('series', []):
+                count += self.to_lines(series['columns'], series['values'], buf)
+            if count >= self.chunk_size:
+                self._enqueue(window, bytes(buf), count)
+                buf = bytearray()
+                count = 0
+        if count:
+            self._enqueue(window, bytes(buf), count)
+        with self._progress_lock:
+            self._finished.add(window)
+        self._window_progress(window, 0)
+
+    def _enqueue(self, window, lines, count):
+        with self._progress_lock:
+            self._outstanding[window] = self._outstanding.get(window, 0) + 1
+        self._queue.put((window, lines, count))
+
+    def _window_progress(self, window, points, acknowledged=0):
+        '''
+        account for an acknowledged batch and checkpoint the window once its
+        reader is done and every batch has been written
+        '''
+        with self._progress_lock:
+            self._outstanding[window] = self._outstanding.get(window, 0) - acknowledged
+            self._written[window] = self._written.get(window, 0) + points
+            complete = window in self._finished and self._outstanding[window] == 0
+            if complete:
+                written = self._written.pop(window)
+                del self._outstanding[window]
+                self._finished.discard(window)
+        if complete and self._checkpointing:
+            self._checkpoint.mark_done(window[0], written)
+
+    def write_batches(self, write_api, progress, task):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            window, lines, count = item
+            for attempt in range(WRITE_RETRIES):
+                try:
+                    write_api.write(bucket=db2_bucket, record=lines)
                     break
+                except Exception as error:
+                    logging.warning("write of window {} failed: {}".format(window, error))
+                    if attempt + 1 < WRITE_RETRIES:
+                        time.sleep(2 ** attempt)
+            else:
+                # never raise here, the readers would block on the full queue
+                self._failed.append(window)
+                continue
+            progress.update(task, advance=count)
+            self._window_progress(window, count, acknowledged=1)
+
+    def run(self, client2, progress):
+        total_points = self.count_points()
+        logging.info("Measurement {} has {} points".format(self.meas15, total_points))
+        bounds = self.time_range()
+        if bounds is None:
+            logging.info("Nothing to migrate")
+            return True
+        windows = self.windows(*bounds)
+        logging.info("Migrating {} windows of {}s with {} readers".format(
+            len(windows), self.window // 10**9, self.workers))
+        return self.migrate(client2, progress, windows, total_points,
+                            self._checkpoint.acknowledged)
+
+    def migrate(self, client2, progress, windows, total_points, done=0):
+        '''
+        read the windows from 1.x and write them to 2.x, True when all of
+        them made it
+        '''
+        task = progress.add_task("[cyan]Migrating ({},{}) -> ({},{})...".format(
+            self.meas15, ','.join(self.fields), self.meas2,
+            ','.join(self.fields.values())), total=total_points)
+        progress.update(task, advance=done)
+        self.resolve_types()
+        write_api = client2.write_api(write_options=SYNCHRONOUS)
+        writers = [threading.Thread(target=self.write_batches,
+                                    args=(write_api, progress, task))
+                   for i in range(self.writers)]
+        for writer in writers:
+            writer.start()
+
+        ts = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(self.read_window, w): w for w in windows}
+        try:
+            for future, window in futures.items():
+                try:
+                    future.result()
+                except Exception as error:
+                    logging.error("read of window {} failed: {}".format(window, error))
+                    self._failed.append(window)
+        except KeyboardInterrupt:
+            logging.info("Received keyboard interrupt. Exiting...")
+            self._stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        finally:
+            # the writers keep draining the queue, so blocked readers finish
+            executor.shutdown(wait=True)
+            for writer in writers:
+                self._queue.put(None)
+            for writer in writers:
+                writer.join()
+            write_api.close()
+
+        logging.info("Migrated ({},{}) in {:.1f}s".format(
+            self.meas15, ','.join(self.fields), time.monotonic() - ts))
+        for window in sorted(self._failed):
+            logging.error("window {} was not migrated".format(window))
+        return not self._failed and not self._stop.is_set()
+
+    def verify_fields(self):
+        '''
+        [(db15 field, db2 field, numeric)] of the job, sum/min/max are only
+        compared for numeric fields
+        '''
+        types = self.source_field_types()
+        return [(src, dst, bool(types.get(src)) and types[src] <= {'float', 'integer'})
+                for src, dst in self.fields.items()]
+
+    def source_stats(self, a, b, fields):
+        '''
+        {(window start, db2 field): (count, sum, min, max)} of the source
+        windows between a and b, for the windows holding the field
+        '''
+        columns = []
+        for i, (src, dst, numeric) in enumerate(fields):
+            columns.append(f'COUNT("{src}") AS "c{i}"')
+            if numeric:
+                columns += [f'SUM("{src}") AS "s{i}"', f'MIN("{src}") AS "n{i}"',
+                            f'MAX("{src}") AS "x{i}"']
+        query = (f'SELECT {",".join(columns)} FROM "{self.meas15}" '
+                 f'WHERE time >= {a} AND time < {b} GROUP BY time({self.window}ns)')
+        stats = {}
+        for point in self._client15().query(query, epoch='ns').get_points():
+            for i, (src, dst, numeric) in enumerate(fields):
+                if point.get(f'c{i}'):
+                    stats[(point['time'], dst)] = (
+                        point[f'c{i}'], point.get(f's{i}'), point.get(f'n{i}'),
+                        point.get(f'x{i}'))
+        return stats
 
-                points = []
-
-                # Write data to InfluxDB 2.6
-                ts = time.monotonic()
-                for result in result_set:
-                    for record in result:
-                        point = Point(meas2)
-                        point.field(field2, record[field15])
-                        if (field2 == 'temp_c'):
-                            temp_f = record[field15]*1.8 + 32
-                            point.field('temp_f', temp_f)
-                        point.time(record["time"])
-                        points.append(point)
-                te = time.monotonic()
-                tp = round(te - ts, 2)
-
-                ts = time.monotonic()
-                write_api.write(bucket=db2_bucket, record=points)
-                te = time.monotonic()
-                tw = round(te - ts, 2)
-
-                # Update the offset
-                offset += chunk_size
-                num_str = "{:>11d}".format(offset)
-                progress.update(task, advance=chunk_size)
-                logging.info(
-                    "{}/{} migrated --- times {}/{}/{}".format(num_str, total_points, tq, tp, tw))
-                time.sleep(1)
-
-    except KeyboardInterrupt:
-        logging.info("Received keyboard interrupt. Exiting...")
+    def destination_stats(self, query_api, a, b, fields):
+        '''
+        the same as source_stats() from the 2.x bucket, over every series
+        of the measurement whatever its tags
+        '''
+        names = ', '.join(flux_string(dst) for src, dst, numeric in fields)
+        numbers = ', '.join(flux_string(dst) for src, dst, numeric in fields if numeric)
+        flux = f'''
+data = from(bucket: {flux_string(db2_bucket)})
+  |> range(start: time(v: {a}), stop: time(v: {b}))
+  |> filter(fn: (r) => r._measurement == {flux_string(self.meas2)} and contains(value: r._field, set: [{names}]))
+  |> group(columns: ["_field"])
+  |> window(every: {self.window}ns)
+data |> count() |> yield(name: "count")
+'''
+        if numbers:
+            flux += f'''
+numbers = data |> filter(fn: (r) => contains(value: r._field, set: [{numbers}]))
+numbers |> sum() |> yield(name: "sum")
+numbers |> min() |> yield(name: "min")
+numbers |> max() |> yield(name: "max")
+'''
+        slots = {'count': 0, 'sum': 1, 'min': 2, 'max': 3}
+        stats = {}
+        for table in query_api.query(flux, org=db2_org):
+            for record in table.records:
+                key = (to_ns(record.get_start()), record.get_field())
+                stats.setdefault(key, [0, None, None, None])
+                stats[key][slots[record.values['result']]] = record.get_value()
+        return {key: tuple(value) for key, value in stats.items() if value[0]}
 
+    def verify(self, client2, progress, windows=None):
+        '''
+        compare every window of the source time range (or the given
+        windows) between 1.x and 2.x, the source and destination queries
+        of all blocks of windows run in parallel on the reader pool
+
+        returns {window start: [(db2 field, kind, source, destination)]}
+        for the windows that differ, kind is "missing" (fewer points in
+        2.x), "extra" (more points in 2.x, e.g. written by the agents),
+        "differs" (same count, other values) or "unverified" (a query
+        failed); source and destination are (count, sum, min, max)
+        '''
+        ts = time.monotonic()
+        if windows is None:
+            bounds = self.time_range()
+            if bounds is None:
+                logging.info("Nothing to verify")
+                return {}
+            first, last = bounds
+            span = self.window * self.verify_block
+            start = first - first % self.window
+            blocks = [(a, a + span) for a in range(start, last + 1, span)]
+            checked = (last - start) // self.window + 1
+        else:
+            blocks = windows
+            checked = len(windows)
+        fields = self.verify_fields()
+        query_api = client2.query_api()
+        task = progress.add_task("[cyan]Verifying ({},{}) -> ({},{})...".format(
+            self.meas15, ','.join(self.fields), self.meas2,
+            ','.join(self.fields.values())), total=len(blocks))
+
+        source = {}
+        destination = {}
+        differing = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [(executor.submit(self.source_stats, a, b, fields),
+                        executor.submit(self.destination_stats, query_api, a, b, fields),
+                        (a, b)) for a, b in blocks]
+            for from_source, from_destination, (a, b) in futures:
+                try:
+                    source.update(from_source.result())
+                    destination.update(from_destination.result())
+                except Exception as error:
+                    logging.error("verification of {} to {} failed: {}".format(
+                        format_window(a), format_window(b), error))
+                    for w in range(a, b, self.window):
+                        differing[w] = [('*', 'unverified', None, None)]
+                progress.update(task, advance=1)
+
+        empty = (0, None, None, None)
+        for key in set(source) | set(destination):
+            w, field = key
+            src = source.get(key, empty)
+            dst = destination.get(key, empty)
+            if src[0] > dst[0]:
+                kind = 'missing'
+            elif src[0] < dst[0]:
+                kind = 'extra'
+            elif not all(close_enough(x, y) for x, y in zip(src[1:], dst[1:])):
+                kind = 'differs'
+            else:
+                continue
+            differing.setdefault(w, []).append((field, kind, src, dst))
+
+        for w, differences in sorted(differing.items()):
+            for field, kind, src, dst in differences:
+                logging.warning("{} {} {}: source {} destination {}".format(
+                    format_window(w), field, kind, src, dst))
+        logging.info("Verified {} windows of ({},{}) in {:.1f}s, {} differ".format(
+            checked, self.meas15, ','.join(self.fields), time.monotonic() - ts,
+            len(differing)))
+        return differing
+
+    def repair(self, client2, progress):
+        '''
+        verify, then migrate again the windows with missing, different or
+        unverified points and verify those once more; windows that only
+        have extra points in 2.x are reported but left alone
+        '''
+        differing = self.verify(client2, progress)
+        windows = [(w, w + self.window) for w, differences in sorted(differing.items())
+                   if any(kind != 'extra' for field, kind, src, dst in differences)]
+        if not windows:
+            return True
+        total_points = sum(max((src or (0,))[0] for field, kind, src, dst in differing[w])
+                           for w, _ in windows)
+        logging.info("Migrating {} windows again".format(len(windows)))
+        self._checkpointing = False
+        if not self.migrate(client2, progress, windows, total_points):
+            return False
+        remaining = self.verify(client2, progress, windows)
+        return not any(kind != 'extra' for differences in remaining.values()
+                       for field, kind, src, dst in differences)
+
+
+# Connect to InfluxDB 2.x
+client2 = InfluxDBClient(url=db2_url, token=db2_token, org=db2_org)
+
+ok = True
+try:
+    with rich.progress.Progress() as progress:
+        for p2migrate in input_dict["migration"]:
+            migrator = WindowMigrator(p2migrate)
+            if args.verify:
+                logging.info("Verifying:\n{}".format(json.dumps(p2migrate, indent=4)))
+                if migrator.verify(client2, progress):
+                    ok = False
+                continue
+            if args.repair:
+                logging.info("Repairing:\n{}".format(json.dumps(p2migrate, indent=4)))
+                ok = migrator.repair(client2, progress)
+            else:
+                logging.info("Migrating:\n{}".format(json.dumps(p2migrate, indent=4)))
+                ok = migrator.run(client2, progress)
+            if not ok:
+                break
+finally:
     # Close the connections
-    client15.close()
-    client2.__del__()
+    client2.close()
+
+sys.exit(0 if ok else 1)